@@ -6,8 +6,14 @@
 ### IMPORTS ###
 ###############
 
-import sys, os, argparse, datetime, math, functools, tarfile, io, time
-from PIL import Image
+import time
+start_time = time.perf_counter()
+# startup is timed from here, imports included
+
+import sys, os, argparse, datetime, math, functools, tarfile, io, json, zlib, threading, queue, itertools, random
+import collections, tempfile, mmap, contextlib, struct, base64, socket, hashlib, re
+# asyncio, http, multiprocessing and concurrent.futures are imported where
+# they are used, as most starts do not need them
 
 
 
@@ -24,6 +30,8 @@ __author__ = "BlackBeans"
 ## COMMANDLINE ARGUMENTS ##
 ###########################
 
+FORMATS = {'string', 'png', 'jpeg', 'bmp', 'tga'}
+
 parser = argparse.ArgumentParser(
     prog='BlackBBoard',
     description='''\
@@ -39,7 +47,7 @@ parser.add_argument('-p', '--penwidth', help='width of the pen', default=4, type
 parser.add_argument('-s', '--session', help='session name', default='%Y-%m-%d-%H-%M-%S')
 parser.add_argument('--width', help='set the width of the window', type=int, default=1280)
 parser.add_argument('--height', help='set the height of the window', type=int, default=1024)
-parser.add_argument('-f', '--format', help='format of output files', default='png', choices={'string', 'png', 'jpeg', 'bmp', 'tga'})
+parser.add_argument('-f', '--format', help='format of output files', default='png', choices=FORMATS)
 parser.add_argument('-d', '--dir', help='target directory to save session pages', default='blackbboard')
 parser.add_argument('--chunk-size', type=int, help='size of each chunk', default=300)
 parser.add_argument('-v', '--version', action='version', version='%(prog)s '+__version__)
@@ -47,7 +55,35 @@ parser.add_argument('-P', '--ppp', help='inverse speed of scale of pen width', d
 parser.add_argument('-F', '--fps', help='set maximum fps (higher values improve drawing at cost of more ressources)', default=60, type=int)
 parser.add_argument('--scale-x', help='set the scale factor corresponding to the number of pixel the screen horizontally moves per pixel the pen moves', type=int, default=1)
 parser.add_argument('--scale-y', help='set the scale factor corresponding to the number of pixel the screen vertically moves per pixel the pen moves', type=int, default=1)
-args = parser.parse_args()
+parser.add_argument('-U', '--undo-memory', help='memory budget of the undo/redo history, in kilobytes', default=32768, type=int)
+parser.add_argument('--fill-limit', help='largest region the bucket (b key) fills, in megapixels', default=16, type=int)
+parser.add_argument('-A', '--autosave', help='save the current session every AUTOSAVE seconds (0 disables autosave)', default=0, type=int)
+parser.add_argument('--persist', help='save the current session when quitting', action='store_true')
+parser.add_argument('-M', '--chunk-memory', help='memory budget of the decoded chunks, in megabytes, three quarters of it shared by the layers, an eighth for the composites of the layers and an eighth for the overview tiles (0 keeps every chunk decoded)', default=1024, type=int)
+parser.add_argument('--chunk-spill', help='where chunks evicted from the budget go', default='zlib', choices=['zlib', 'mmap'])
+parser.add_argument('-j', '--workers', help='number of processes encoding and decoding chunks (1 disables the pool)', default=os.cpu_count() or 1, type=int)
+parser.add_argument('--chunk-backend', help='how chunks are filled and checked for ink (defaults to numpy when NumPy is installed)', choices=['pygame', 'numpy'])
+parser.add_argument('--batch', help='run ACTION on each of the SESSIONS (names or directories of saved sessions), spread over the worker processes, and quit', choices=['convert', 'pages', 'export', 'verify', 'stats'], metavar='ACTION')
+parser.add_argument('sessions', help='sessions for --batch, the current session by default', nargs='*', metavar='SESSIONS')
+parser.add_argument('--compact', help='rewrite the current session without its superseded and empty chunks, and quit', action='store_true')
+parser.add_argument('--export', help='render the whole board into FILE (.png, .tif or .pdf, tiled at window size) and quit', metavar='FILE')
+parser.add_argument('--export-rect', help='only export this rectangle of the board', nargs=4, type=int, metavar=('X', 'Y', 'W', 'H'))
+parser.add_argument('--export-scale', help='divide the size of the export by SCALE', default=1, type=int, metavar='SCALE')
+parser.add_argument('--bench', help='run the given benchmark and quit', choices=['codec', 'flush', 'chunks', 'serve', 'tiles', 'strokes'])
+parser.add_argument('--serve', help='share the session with the boards connecting to [HOST:]PORT, without a window', metavar='[HOST:]PORT')
+parser.add_argument('--serve-tiles', help='serve the saved session as map tiles to web browsers on [HOST:]PORT (localhost by default), without a window', metavar='[HOST:]PORT')
+parser.add_argument('--connect', help='draw on the board shared by the server at [HOST:]PORT', metavar='[HOST:]PORT')
+parser.add_argument('--idle-timeout', help='maximum time in milliseconds the board sleeps waiting for input when idle', default=1000, type=int)
+parser.add_argument('--record', help='record every input event into the given trace file', metavar='TRACE')
+parser.add_argument('--replay', help='replay the given trace file as fast as possible, report events per second and quit', metavar='TRACE')
+parser.add_argument('--headless', help='run without a window, on SDL\'s dummy video driver', action='store_true')
+parser.add_argument('--stats', help='print loop statistics on exit', action='store_true')
+parser.add_argument('--profile', help='time each frame, showing rolling percentiles on a key press and writing per-frame timings to LOG', metavar='LOG')
+args = parser.parse_args(None if __name__ in ('__main__', '__mp_main__') else [])
+# imported as a library, the board has its default settings; the chunk pool
+# workers import it as __mp_main__, with the arguments of the board
+if args.sessions and not args.batch:
+    parser.error('sessions can only be given with --batch')
 
 
 
@@ -55,9 +91,19 @@ args = parser.parse_args()
 ### IMPORTS ###
 ###############
 
+# after the arguments, so that --help does not wait on them; PIL is only
+# imported when first used
+try:
+    import numpy
+except ImportError:
+    numpy = None
+if args.chunk_backend == 'numpy' and numpy is None:
+    parser.error('the numpy chunk backend needs NumPy')
 import pygame
 import pygame.gfxdraw
 from pygame.locals import *
+if numpy is not None:
+    import pygame.surfarray
 
 
 
@@ -69,17 +115,93 @@ FPS = args.fps
 SCREENSIZE = (args.width,args.height)
 PPP = args.ppp
 BASEDIR = os.path.dirname(os.path.abspath(__file__))
-MAXUNDO = 5
+UNDOMEMORY = args.undo_memory*1024
+HISTORYFORMAT = 'RGBA'
+HISTORYLEVEL = 1
+FILLLIMIT = args.fill_limit*1024*1024
+FILLTOLERANCE = 48
+# largest difference per channel, on white, of the pixels the bucket fills
+STROKESLOP = 4
+# pixels around a stroke still picking it
+CHUNKMEMORY = args.chunk_memory*1024*1024
+LAYERMEMORY = CHUNKMEMORY*3//4
+# shared by the layers
+COMPOSITEMEMORY = CHUNKMEMORY//8
+CHUNKSPILL = args.chunk_spill
+CHUNKLEVEL = 1
+CHUNKBACKEND = args.chunk_backend or ('pygame' if numpy is None else 'numpy')
 MOVESCALE = (args.scale_x, args.scale_y)
+IDLETIMEOUT = args.idle_timeout
+STATS = args.stats
+RECORD = args.record
+REPLAY = args.replay
+HEADLESS = args.headless
+PROFILE = args.profile
+TIMING = bool(STATS or REPLAY or PROFILE)
+PROFILEWINDOW = 120
+PROFILEREFRESH = 15
+PROFILELINES = 12
+SERVERTICK = 30
+SERVERQUEUE = 1024
+SERVERLINE = 64*1024*1024
+SERVERCACHE = 1024
+SERVERVIEW = 8192
+# largest side of the window of a client, which is dropped if it sends a
+# larger one
+TILECACHE = 64*1024*1024
+TILELEVEL = 3
+PREFETCH = 4
 
 # Cursession
 # **********
 CSFILE = 'cursession'
+CSPACK = 'cursession.pack'
+CSPACKMASK = 'cursession.pack.{n}'
+CSINDEX = 'cursession.idx'
+CSJOURNAL = 'cursession.journal.'
+JOURNALSYNC = 1000
+JOURNALLIMIT = 4*1024*1024
+MIPPACK = 'overview.pack'
+MIPPACKMASK = 'overview.pack.{n}'
+MIPINDEX = 'overview.idx'
+LAYERPACK = 'layer{id}.pack'
+LAYERPACKMASK = 'layer{id}.pack.{{n}}'
+LAYERINDEX = 'layer{id}.idx'
+LAYERSTROKES = 'layer{id}.strokes'
+LAYERFILE = 'layers.json'
+# order and visibility of the layers, the base one being saved as cursession
+MIPFORMAT = 'zlib'
+MIPLEVELS = 5
+MIPPERSIST = 2
+MIPBUILDS = 32
+MIPMEMORY = CHUNKMEMORY//8
+EXPORTLEVEL = 6
 CSIMGFORMAT = 'RGBA'
-CSARCHWMODE = 'w:gz'
 CSARCHRMODE = 'r:gz'
-CSCHUNKMASK = '{x}.{y}.chunk'
-CSPERSISTANCE = False
+CSUNIFORM = 'uniform'
+# format of chunks filled with a single color, stored as that RGBA color
+CSPOOLFORMATS = {'png', 'jpeg'}
+# formats costly enough to encode and decode in the chunk pool
+CSOPAQUE = {'jpeg'}
+# formats without alpha, whose chunks are flattened on white
+CSCOMPACT = 0.5
+# share of a pack below which its latest chunks fall before a save compacts it
+BATCHPROBLEMS = 5
+CSPERSISTANCE = args.persist
+AUTOSAVE = args.autosave*1000
+WORKERS = args.workers
+
+# Custom events
+# *************
+AUTOSAVE_EVENT = USEREVENT
+WRITER_EVENT = USEREVENT+1
+JOURNAL_EVENT = USEREVENT+2
+NET_EVENT = USEREVENT+3
+
+# Writer
+# ******
+WRITERPROGRESS = 0.1
+INTERNALEVENTS = [AUTOSAVE_EVENT, WRITER_EVENT, JOURNAL_EVENT, NET_EVENT]
 
 # Key aliases
 # ***********
@@ -91,8 +213,19 @@ KEY_COPY   = 'c'
 KEY_PASTE  = 'v'
 KEY_DELETE = 'd'
 KEY_FILL   = 'f'
+KEY_BUCKET = 'b'
 KEY_UNDO   = 'z'
+KEY_REDO   = 'y'
+KEY_DEBUG  = 'i'
+KEY_PROFILE = 'p'
+KEY_OVERVIEW = 'o'
+KEY_EXPORT = 'e'
 KEY_SAVECS = 'a'
+KEY_LAYER  = 'l'
+KEY_HIDE   = 'h'
+KEY_RAISE  = 'r'
+KEY_STROKES = 'k'
+KEY_RESTYLE = 't'
 
 # Tool names
 # *********
@@ -140,27 +273,384 @@ pencolor = black
 #### CLASSES ####
 #################
 
-class Surface:
-    def __init__(self, chunksize, chunks=None):
+class Timings:
+    # Total time spent in, and count of, each phase of the board, and the
+    # time spent per frame over the last `window' frames; when disabled,
+    # timed functions are left untouched
+    def __init__(self, enabled, window=PROFILEWINDOW):
+        self.enabled = enabled
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.current = collections.defaultdict(float)
+        self.window = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.frame_start = time.perf_counter()
+    def add(self, name, elapsed):
+        self.totals[name] += elapsed
+        self.counts[name] += 1
+        self.current[name] += elapsed
+    def end_frame(self):
+        # Returns the time spent per phase since the previous call
+        now = time.perf_counter()
+        frame, self.current = self.current, collections.defaultdict(float)
+        frame['frame'] = now - self.frame_start
+        self.frame_start = now
+        for name in self.totals.keys() | {'frame'}:
+            self.window[name].append(frame.get(name, 0.))
+        return frame
+    def percentiles(self, name, ps=(50, 95, 99)):
+        values = sorted(self.window[name])
+        return [values[min(len(values)-1, len(values)*p//100)] for p in ps]
+    def timed(self, name):
+        def decorator(function):
+            if not self.enabled:
+                return function
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.add(name, time.perf_counter()-start)
+            return wrapper
+        return decorator
+    def phase(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timer(name)
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter()-start)
+    def report(self):
+        print('%-10s %8s %10s %10s' % ('phase', 'count', 'total s', 'mean ms'))
+        for name in sorted(self.totals):
+            print('%-10s %8s %10.3f %10.3f' % (name, self.counts[name], self.totals[name], 1000*self.totals[name]/self.counts[name]))
+
+timings = Timings(TIMING)
+
+class PygameChunks:
+    # The operations the board runs on every chunk it reclaims, erases or
+    # fills: finding its single color and filling an area of it, with
+    # pygame primitives
+    def color(self, chunk):
+        # The color of `chunk' if it is uniform (transparent if it is
+        # empty), None otherwise
+        bounds = chunk.get_bounding_rect()
+        if not bounds:
+            return transparent
+        if bounds.size != chunk.get_size():
+            return None
+        w, h = chunk.get_size()
+        color = chunk.get_at((0,0))
+        if chunk.get_at((w-1,0)) != color or chunk.get_at((0,h-1)) != color or chunk.get_at((w-1,h-1)) != color:
+            return None
+        return raw_color(pygame.image.tostring(chunk, CSIMGFORMAT))
+    def fill(self, chunk, area, color):
+        chunk.fill(color, area)
+
+class NumpyChunks(PygameChunks):
+    # Same, on NumPy views of the pixels of the chunks rather than copies;
+    # views lock their chunk, so none outlives a call
+    def color(self, chunk):
+        if not pygame.surfarray.pixels_alpha(chunk).any():
+            return transparent
+        pixels = pygame.surfarray.pixels2d(chunk)
+        if (pixels != pixels[0,0]).any():
+            return None
+        return tuple(chunk.unmap_rgb(pixels[0,0]))
+    def fill(self, chunk, area, color):
+        pygame.surfarray.pixels2d(chunk)[area.left:area.right, area.top:area.bottom] = chunk.map_rgb(color)
+
+CHUNKBACKENDS = {'pygame': PygameChunks, 'numpy': NumpyChunks}
+backend = CHUNKBACKENDS[CHUNKBACKEND]()
+
+class History:
+    # Undo/redo stacks of steps, each step being a list of
+    # (chunk pos, area, before, after) with compressed pixels of the area
+    def __init__(self, budget):
+        self.budget = budget
+        self.undos = []
+        self.redos = []
+        self.size = 0
+    @staticmethod
+    def step_size(step):
+        return sum(len(before)+len(after) for _, _, before, after in step)
+    def push(self, step):
+        if not step:
+            return
+        for old in self.redos:
+            self.size -= self.step_size(old)
+        self.redos = []
+        self.undos.append(step)
+        self.size += self.step_size(step)
+        while self.size > self.budget and len(self.undos) > 1:
+            self.size -= self.step_size(self.undos.pop(0))
+    def undo(self):
+        if len(self.undos) == 0:
+            return None
+        step = self.undos.pop()
+        self.redos.append(step)
+        return step
+    def redo(self):
+        if len(self.redos) == 0:
+            return None
+        step = self.redos.pop()
+        self.undos.append(step)
+        return step
+
+class SpillFile:
+    # Fixed-size slots in an anonymous temporary file, mapped in memory
+    def __init__(self, slotsize):
+        self.slotsize = slotsize
+        self.file = tempfile.TemporaryFile()
+        self.map = None
+        self.slots = 0
+        self.free = []
+    def grow(self):
+        slots = max(16, 2*self.slots)
+        self.file.truncate(slots*self.slotsize)
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), slots*self.slotsize)
+        self.free.extend(range(slots-1, self.slots-1, -1))
+        self.slots = slots
+    def put(self, data):
+        if not self.free:
+            self.grow()
+        slot = self.free.pop()
+        self.map[slot*self.slotsize:slot*self.slotsize+len(data)] = data
+        return slot
+    def get(self, slot):
+        return self.map[slot*self.slotsize:(slot+1)*self.slotsize]
+    def release(self, slot):
+        self.free.append(slot)
+
+class ChunkCache:
+    # Mapping of positions to chunks keeping at most `budget' bytes of them
+    # decoded; the least recently used are packed, compressed in memory or
+    # in a spill file, unless `drop' takes them back
+    def __init__(self, chunksize, budget, spill):
         self.chunksize = chunksize
-        if chunks == None:
-            self.chunks = {}
+        self.chunkbytes = chunksize*chunksize*4
+        self.resident = collections.OrderedDict()
+        self.packed = {}
+        self.spill = SpillFile(self.chunkbytes) if spill == 'mmap' else None
+        self.drop = lambda pos: False
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'drops': 0}
+        self.resize(budget)
+    def resize(self, budget):
+        # never packs what a couple of screens show
+        floor = 2*(SCREENSIZE[0]//self.chunksize+2)*(SCREENSIZE[1]//self.chunksize+2)
+        self.limit = max(budget//self.chunkbytes, floor) if budget else None
+        self.shrink()
+    def __contains__(self, pos):
+        return pos in self.resident or pos in self.packed
+    def __iter__(self):
+        return itertools.chain(self.resident, self.packed)
+    def __len__(self):
+        return len(self.resident) + len(self.packed)
+    def __getitem__(self, pos):
+        if pos in self.resident:
+            self.stats['hits'] += 1
+            self.resident.move_to_end(pos)
+            return self.resident[pos]
+        data = self.raw(pos)
+        self.stats['misses'] += 1
+        chunk = pygame.image.fromstring(data, (self.chunksize,self.chunksize), CSIMGFORMAT)
+        self[pos] = chunk
+        return chunk
+    def __setitem__(self, pos, chunk):
+        if pos in self.packed:
+            self.unpack(pos)
+        self.resident[pos] = chunk
+        self.resident.move_to_end(pos)
+        self.shrink()
+    def __delitem__(self, pos):
+        if pos in self.packed:
+            self.unpack(pos)
         else:
-            self.chunks = chunks
-        self.lasts = []
+            del self.resident[pos]
+    def update(self, chunks):
+        for pos, chunk in (chunks.items() if hasattr(chunks, 'items') else chunks):
+            self[pos] = chunk
+    def items(self):
+        for pos in list(self):
+            yield pos, self[pos]
+    def raw(self, pos):
+        # Pixels of a chunk, without decoding it if it is packed
+        if pos in self.resident:
+            return pygame.image.tostring(self.resident[pos], CSIMGFORMAT)
+        if self.spill is not None:
+            return self.spill.get(self.packed[pos])
+        return zlib.decompress(self.packed[pos])
+    def unpack(self, pos):
+        data = self.packed.pop(pos)
+        if self.spill is not None:
+            self.spill.release(data)
+    def shrink(self):
+        while self.limit is not None and len(self.resident) > self.limit:
+            pos, chunk = self.resident.popitem(last=False)
+            self.stats['evictions'] += 1
+            if self.drop(pos):
+                self.stats['drops'] += 1
+                continue
+            data = pygame.image.tostring(chunk, CSIMGFORMAT)
+            if self.spill is not None:
+                self.packed[pos] = self.spill.put(data)
+            else:
+                self.packed[pos] = zlib.compress(data, CHUNKLEVEL)
+
+class Surface:
+    vector = False
+    # whether the layer keeps its pen strokes, see StrokeSurface
+    def __init__(self, chunksize, chunks=None, store=None):
+        self.chunksize = chunksize
+        self.chunks = ChunkCache(chunksize, LAYERMEMORY, CHUNKSPILL)
+        self.chunks.drop = self.drop_chunk
+        if chunks != None:
+            self.chunks.update(chunks)
+        self.uniform = {}
+        # positions of the chunks filled with a single color, and that color
+        self.fills = {}
+        # read-only chunks shown for uniform ones, by color
+        self.history = History(UNDOMEMORY)
+        self.dirty = set()
+        # positions of the chunks modified since the last session save
+        self.stale = set()
+        # positions of the chunks modified since the pyramid last saw them
+        self.touched = lambda pos: None
+        self.shared = set()
+        # positions of the chunks also held by a clip, copied before the
+        # board next writes them
+        self.store = store
+        self.stored = set(store.index).difference(self.chunks) if store else set()
+        # positions of the chunks only decoded from `store' when first needed
     def get_chunk(self, pos, write):
+        if pos in self.uniform:
+            if not write:
+                return self.fill_chunk(self.uniform[pos])
+            color = self.uniform.pop(pos)
+            self.create_chunk(pos)
+            self.chunks[pos].fill(color)
         if pos not in self.chunks:
-            if write: self.create_chunk(pos)
+            if pos in self.stored: self.load([pos])
+            elif write: self.create_chunk(pos)
             else: return False
+        if pos not in self.chunks:
+            return self.get_chunk(pos, write)
+        if write and pos in self.shared:
+            self.shared.discard(pos)
+            self.chunks[pos] = self.chunks[pos].copy()
         return self.chunks[pos]
-    def undo(self):
-        if len(self.lasts) == 0:
+    def fill_chunk(self, color):
+        if color not in self.fills:
+            self.fills[color] = pygame.Surface((self.chunksize,self.chunksize), SRCALPHA)
+            self.fills[color].fill(color)
+        return self.fills[color]
+    @timings.timed('load')
+    def load(self, positions):
+        # Decodes stored chunks in one batch
+        if not positions:
+            return
+        self.stored.difference_update(positions)
+        try:
+            entries = [(pos,)+self.store.read(pos) for pos in positions]
+            for pos, data, format in entries:
+                if format == CSUNIFORM:
+                    self.uniform[pos] = tuple(data)
+            entries = [entry for entry in entries if entry[2] != CSUNIFORM]
+            if not entries:
+                return
+            positions, strings, formats = zip(*entries)
+            chunks = load_chunks(strings, self.chunksize, formats)
+        except Exception as e:
+            print('Error while loading chunks %s: %s' % (', '.join(map(str, positions)), e))
             return
-        current = self.lasts.pop()
-        self.chunks.update(current)
+        self.chunks.update(zip(positions, chunks))
+    def drop_chunk(self, pos):
+        # Chunks evicted from the cache are simply decoded again from the
+        # store if they did not change since it was written
+        if self.store is None or pos in self.dirty or writer.pending or pos not in self.store.index:
+            return False
+        self.stored.add(pos)
+        return True
+    def touch(self, pos):
+        self.dirty.add(pos)
+        self.stale.add(pos)
+        self.touched(pos)
+    def exists(self, pos):
+        return pos in self.chunks or pos in self.uniform or pos in self.stored
+    def positions(self):
+        # Positions of every chunk, loaded or not
+        return self.stored.union(self.chunks, self.uniform)
+    def bounds(self):
+        # Board rectangle covering every chunk
+        positions = self.positions()
+        if not positions:
+            return pygame.Rect(0,0,0,0)
+        cs = self.chunksize
+        bounds = pygame.Rect(-max(x for x, y in positions)*cs, -max(y for x, y in positions)*cs, 0, 0)
+        bounds.union_ip(pygame.Rect(-min(x for x, y in positions)*cs, -min(y for x, y in positions)*cs, cs, cs))
+        return bounds
+    @timings.timed('snapshot')
+    def snapshot(self, chunk, area):
+        return pygame.image.tostring(chunk.subsurface(area), HISTORYFORMAT)
+    def edit(self, pos, area, step, function):
+        # Applies `function' to the chunk at `pos', recording `area' in `step'
+        # only compressed if it changed
+        chunk = self.get_chunk(pos, True)
+        before = self.snapshot(chunk, area)
+        function(chunk)
+        after = self.snapshot(chunk, area)
+        if after != before:
+            step.append((pos, area, zlib.compress(before, HISTORYLEVEL), zlib.compress(after, HISTORYLEVEL)))
+            self.touch(pos)
+    def commit(self, step, touched):
+        # `touched' chunks may have been left empty or uniform
+        self.history.push(step)
+        self.reclaim(touched)
+        return [(pos, area) for pos, area, _, _ in step]
+    def reclaim(self, positions):
+        # Drops chunks left empty, and keeps uniform ones as a single color
+        for pos in set(positions):
+            if pos not in self.chunks:
+                continue
+            color = backend.color(self.chunks[pos])
+            if color is None:
+                continue
+            del self.chunks[pos]
+            if color[3]:
+                self.uniform[pos] = color
+            self.touch(pos)
+    def restore(self, pos, area, data):
+        pixels = pygame.image.fromstring(zlib.decompress(data), area.size, HISTORYFORMAT)
+        chunk = self.get_chunk(pos, True)
+        chunk.fill(transparent, area)
+        chunk.blit(pixels, area.topleft, special_flags=BLEND_RGBA_MAX)
+        self.touch(pos)
+    def undo(self):
+        # Returns the (pos, area) that changed
+        step = self.history.undo()
+        if step is None:
+            return []
+        for pos, area, before, after in reversed(step):
+            self.restore(pos, area, before)
+        self.reclaim(pos for pos, _, _, _ in step)
+        return [(pos, area) for pos, area, _, _ in step]
+    def redo(self):
+        step = self.history.redo()
+        if step is None:
+            return []
+        for pos, area, before, after in step:
+            self.restore(pos, area, after)
+        self.reclaim(pos for pos, _, _, _ in step)
+        return [(pos, area) for pos, area, _, _ in step]
     def create_chunk(self, pos):
+        self.shared.discard(pos)
         self.chunks[pos] = pygame.Surface((self.chunksize,self.chunksize), SRCALPHA)
-        self.chunks[pos].set_colorkey(white)
         self.chunks[pos].fill(transparent)
     def retrieve_chunks(self, screensize, pos,write=False):
         # Yields chunks that you can possibly see in `surface'
@@ -169,6 +659,14 @@ class Surface:
         #     and chunksize >= surface.width
         # yields (pos,chunk) where pos == chunk.topleft
         # yields at most four chunks
+        positions = list(self.visible(screensize, pos))
+        self.load([pos for pos in positions if pos in self.stored])
+        for pos in positions:
+            chunk = self.get_chunk(pos, write)
+            if chunk:
+                yield mul_tuple(self.chunksize, pos), chunk
+    def visible(self, screensize, pos):
+        # Yields the positions of the chunks retrieve_chunks would yield
         x,y=pos
         ox, oy = -x, -y
         sx, sy = screensize
@@ -178,26 +676,1231 @@ class Surface:
         by = (oy+sy)//self.chunksize
         for x in range(tx, bx+1):
             for y in range(ty, by+1):
-                chunk = self.get_chunk((-x,-y), write)
-                if chunk:
-                    yield (-x*self.chunksize,-y*self.chunksize), chunk
-    def blit(self, surface, pos):
-        last = {}
-        for (x,y), chunk in self.retrieve_chunks(surface.get_size(), pos,write=True):
-            lchunk = chunk.copy()
-            rpos = sub_tuples((x,y),pos)
-            chunk.blit(surface,rpos)
-            last[x//self.chunksize,y//self.chunksize] = lchunk
-        self.lasts.append(last)
-        if len(self.lasts) > MAXUNDO:
-            self.lasts.pop(0)
+                yield (-x,-y)
+    def areas(self, rect):
+        # Yields (pos, area) for every chunk overlapping `rect', given in
+        # board coordinates, where area is the overlap in chunk coordinates
+        cs = self.chunksize
+        for x in range(rect.left//cs, (rect.right-1)//cs+1):
+            for y in range(rect.top//cs, (rect.bottom-1)//cs+1):
+                yield (-x,-y), rect.move(-x*cs,-y*cs).clip(0,0,cs,cs)
+    @timings.timed('blit')
+    def blit(self, surface, pos, rect=None):
+        # Only chunks under `rect' of `surface' (all of it by default) are
+        # written, the rest of `surface' is assumed to be transparent
+        # Returns the (pos, area) that changed
+        step = []
+        return self.commit(step, self.blit_step(step, surface, pos, rect))
+    def blit_step(self, step, surface, pos, rect=None):
+        # Same as blit, recording into `step'
+        # Returns the positions of the chunks it covered whole
+        rect = surface.get_rect() if rect is None else surface.get_rect().clip(rect)
+        areas = list(self.areas(rect.move(mul_tuple(-1, pos))))
+        created = {cpos for cpos, area in areas if not self.exists(cpos)}
+        for cpos, area in areas:
+            rpos = sub_tuples(mul_tuple(self.chunksize, cpos), pos)
+            self.edit(cpos, area, step, lambda chunk: chunk.blit(surface, area, area.move(mul_tuple(-1, rpos))))
+        # blitting cannot empty a chunk, nor make it uniform unless it
+        # covers all of it, which spares scanning the others
+        for cpos in created.difference(cpos for cpos, _, _, _ in step):
+            del self.chunks[cpos]
+        return [cpos for cpos, area in areas if area.size == (self.chunksize,self.chunksize)]
+    def copy(self, rect):
+        # Clip of `rect', given in board coordinates, holding the chunks
+        # themselves until the board next writes them
+        areas = list(self.areas(rect))
+        self.load([pos for pos, area in areas if pos in self.stored])
+        chunks = {}
+        for pos, area in areas:
+            if pos in self.uniform:
+                chunks[pos] = self.uniform[pos]
+            elif pos in self.chunks:
+                chunks[pos] = self.chunks[pos]
+                self.shared.add(pos)
+        return Clip(rect, chunks)
+    def paste(self, clip, pos):
+        # Blits `clip' with its top left corner at `pos', in board coordinates
+        # Returns the (pos, area) that changed
+        step = []
+        full = []
+        delta = sub_tuples(pos, clip.rect.topleft)
+        for cpos, area in self.areas(clip.rect):
+            if cpos not in clip.chunks:
+                continue
+            chunk = clip.chunks[cpos]
+            if isinstance(chunk, tuple):
+                chunk = self.fill_chunk(chunk)
+            full.extend(self.blit_step(step, chunk, sub_tuples(mul_tuple(self.chunksize, cpos), delta), area))
+        return self.commit(step, full)
+    def erase(self, rect):
+        # Clears `rect', given in board coordinates
+        # Returns the (pos, area) that changed
+        step = []
+        for pos, area in self.areas(rect):
+            if self.get_chunk(pos, False):
+                self.edit(pos, area, step, lambda chunk: backend.fill(chunk, area, transparent))
+        return self.commit(step, [pos for pos, area, _, _ in step])
+    @timings.timed('flood')
+    def flood(self, pos, color, limit):
+        # Fills with `color' the region of pixels looking like the one at
+        # `pos', given in board coordinates, whichever chunks it spreads over,
+        # unless it is larger than `limit' pixels; pixels are compared as
+        # shown, on white, one chunk at a time, each handing the edges of its
+        # part of the region on to its neighbours as one pixel wide masks;
+        # chunks of a single color are all in or all out, and chunks filled
+        # whole become a single color
+        # Returns the (pos, area) that changed, None if it was too large
+        cs = self.chunksize
+        start = (-(pos[0]//cs), -(pos[1]//cs))
+        flat = pygame.Surface((cs,cs))
+        def shown(cpos):
+            flat.fill(white)
+            chunk = self.get_chunk(cpos, False)
+            if chunk:
+                flat.blit(chunk, (0,0))
+        dot = pygame.Surface((1,1))
+        ink = pygame.Surface((1,1), SRCALPHA)
+        target = white
+        if self.exists(start):
+            shown(start)
+            target = tuple(flat.get_at((pos[0] % cs, pos[1] % cs)))[:3]
+        if target == tuple(color)[:3]:
+            return []
+        threshold = (FILLTOLERANCE,)*3 + (255,)
+        blank = all(abs(a-b) < FILLTOLERANCE for a, b in zip(target, white))
+        # chunks that do not exist are blank
+        masks = {}
+        whole = set()
+        # chunks all in
+        regions = {}
+        seed = pygame.mask.Mask((1,1), fill=True)
+        pending = {start: [(seed, (pos[0] % cs, pos[1] % cs))]}
+        # edges entering each chunk, and where
+        count = 0
+        while pending:
+            cpos, edges = pending.popitem()
+            if cpos not in masks:
+                if cpos in self.uniform:
+                    dot.fill(white)
+                    ink.fill(self.uniform[cpos])
+                    dot.blit(ink, (0,0))
+                    masks[cpos] = pygame.mask.Mask((cs,cs), fill=pygame.mask.from_threshold(dot, target, threshold).get_at((0,0)))
+                elif self.exists(cpos):
+                    shown(cpos)
+                    masks[cpos] = pygame.mask.from_threshold(flat, target, threshold)
+                else:
+                    masks[cpos] = pygame.mask.Mask((cs,cs), fill=blank)
+                if masks[cpos].count() == cs*cs:
+                    whole.add(cpos)
+                regions[cpos] = pygame.mask.Mask((cs,cs))
+            mask, region = masks[cpos], regions[cpos]
+            before = region.count()
+            for edge, (ex, ey) in edges:
+                seeds = edge.overlap_mask(mask, (-ex,-ey))
+                seeds.erase(region, (-ex,-ey))
+                if seeds.get_size()[0] == 1:
+                    # get_bounding_rects crashes on masks one pixel wide
+                    wide = pygame.mask.Mask((2,cs))
+                    wide.draw(seeds, (0,0))
+                    seeds = wide
+                for rect in seeds.get_bounding_rects():
+                    # a run along the edge is connected, one seed will do
+                    if cpos in whole:
+                        region.fill()
+                        break
+                    if not region.get_at((rect.x+ex, rect.y+ey)):
+                        region.draw(mask.connected_component((rect.x+ex, rect.y+ey)), (0,0))
+            if region.count() == before:
+                continue
+            count += region.count() - before
+            if count > limit:
+                return None
+            x, y = cpos
+            for npos, size, offset, entry in (
+                ((x-1,y), (1,cs), (1-cs,0), (0,0)),
+                ((x+1,y), (1,cs), (0,0), (cs-1,0)),
+                ((x,y-1), (cs,1), (0,1-cs), (0,0)),
+                ((x,y+1), (cs,1), (0,0), (0,cs-1)),
+            ):
+                edge = pygame.mask.Mask(size)
+                edge.draw(region, offset)
+                if edge.count():
+                    pending.setdefault(npos, []).append((edge, entry))
+        step = []
+        snapshots = {}
+        # of the areas of a single color before or after the fill, alike
+        def snapshot(color, size=(cs,cs)):
+            if (color, size) not in snapshots:
+                fill = pygame.Surface(size, SRCALPHA)
+                fill.fill(color)
+                snapshots[color, size] = zlib.compress(pygame.image.tostring(fill, HISTORYFORMAT), HISTORYLEVEL)
+            return snapshots[color, size]
+        def saved(chunk, area):
+            was = backend.color(chunk.subsurface(area))
+            return snapshot(was, area.size) if was is not None else zlib.compress(self.snapshot(chunk, area), HISTORYLEVEL)
+        color = tuple(pygame.Color(color))
+        for cpos, region in regions.items():
+            size = region.count()
+            if not size:
+                continue
+            if size == cs*cs:
+                if cpos in self.chunks:
+                    before = saved(self.chunks[cpos], pygame.Rect(0,0,cs,cs))
+                    del self.chunks[cpos]
+                else:
+                    before = snapshot(self.uniform.get(cpos, transparent))
+                step.append((cpos, pygame.Rect(0,0,cs,cs), before, snapshot(color)))
+                self.uniform[cpos] = color
+                self.touch(cpos)
+                continue
+            area = region.to_surface(unsetcolor=transparent).get_bounding_rect()
+            if size == area.w*area.h:
+                chunk = self.get_chunk(cpos, True)
+                step.append((cpos, area, saved(chunk, area), snapshot(color, area.size)))
+                chunk.fill(color, area)
+                self.touch(cpos)
+            else:
+                self.edit(cpos, area, step, lambda chunk: region.to_surface(chunk, setcolor=color, unsetcolor=None))
+        return self.commit(step, [])
+    def replace(self, pos, chunk):
+        # Sets the chunk at `pos' to `chunk', a surface, a color if it is
+        # uniform or None if it is empty, as a board server sends them
+        self.stored.discard(pos)
+        self.shared.discard(pos)
+        self.uniform.pop(pos, None)
+        if pos in self.chunks:
+            del self.chunks[pos]
+        if isinstance(chunk, tuple):
+            if chunk[3]:
+                self.uniform[pos] = chunk
+        elif chunk is not None:
+            self.chunks[pos] = chunk
+        self.touch(pos)
     def save(self):
         return (self.chunksize, self.chunks)
+    def trace(self, points, color, width):
+        # Polyline drawn on temp_surf, in screen coordinates, that the next
+        # blit commits
+        pass
+
+class StrokeSurface(Surface):
+    # Surface whose pixels are the pen strokes kept by id, in board
+    # coordinates, and indexed by the chunks they cross; removing or
+    # restyling a stroke only draws those chunks again, from the strokes
+    # left there. Undo steps carry the strokes that changed as an extra
+    # (None, None, before, after) entry, with the JSON of {id: stroke}
+    vector = True
+    def __init__(self, chunksize, chunks=None, store=None):
+        super().__init__(chunksize, chunks, store)
+        self.strokes = {}
+        # id: (points, color, width)
+        self.reaches = {}
+        # id: board rectangle within reach of the stroke
+        self.cells = {}
+        # id: positions of the chunks the stroke crosses
+        self.grid = collections.defaultdict(set)
+        # chunk position: ids of the strokes crossing it
+        self.traced = []
+        self.next_id = 0
+    def trace(self, points, color, width):
+        # Motions coalesced into one polyline come back to its last point
+        if self.traced and self.traced[-1][1:] == (color, width) and self.traced[-1][0][-1] == points[0]:
+            self.traced[-1][0].extend(points[1:])
+        else:
+            self.traced.append((list(points), color, width))
+    def segments(self, id):
+        points = self.strokes[id][0]
+        return zip(points, points[1:]) if len(points) > 1 else [(points[0], points[0])]
+    def reach(self, id, a, b):
+        # Board rectangle within reach of the segment from `a' to `b'
+        width = self.strokes[id][2]
+        return make_rect(a, b).inflate(width+STROKESLOP, width+STROKESLOP)
+    def index(self, id, stroke):
+        # Adds the stroke, or removes it if `stroke' is None
+        if id in self.strokes:
+            for pos in self.cells[id]:
+                self.grid[pos].discard(id)
+                if not self.grid[pos]:
+                    del self.grid[pos]
+            del self.strokes[id], self.reaches[id], self.cells[id]
+        if stroke is None:
+            return
+        points, color, width = stroke
+        self.strokes[id] = ([tuple(point) for point in points], tuple(color), width)
+        xs, ys = zip(*self.strokes[id][0])
+        self.reaches[id] = pygame.Rect(min(xs), min(ys), max(xs)-min(xs), max(ys)-min(ys)).inflate(width+STROKESLOP, width+STROKESLOP)
+        self.cells[id] = set()
+        for a, b in self.segments(id):
+            self.cells[id].update(pos for pos, area in self.areas(self.reach(id, a, b)))
+        for pos in self.cells[id]:
+            self.grid[pos].add(id)
+        self.next_id = max(self.next_id, id+1)
+    def hit(self, rect):
+        # Ids of the strokes crossing `rect', given in board coordinates, or
+        # of the topmost one under its top left corner if it is empty
+        cs = self.chunksize
+        if not rect:
+            x, y = rect.topleft
+            for id in sorted(self.grid.get((-(x//cs), -(y//cs)), ()), reverse=True):
+                if self.reaches[id].collidepoint(x, y) and any(self.near(id, a, b, (x, y)) for a, b in self.segments(id)):
+                    return [id]
+            return []
+        ids = set().union(*(self.grid.get(pos, ()) for pos, area in self.areas(rect)))
+        return sorted(id for id in ids if self.reaches[id].colliderect(rect) and any(
+            rect.inflate(self.strokes[id][2], self.strokes[id][2]).clipline(a, b) for a, b in self.segments(id)))
+    def near(self, id, a, b, point):
+        # Whether `point' is on the segment from `a' to `b' as drawn
+        (ax, ay), (bx, by), (px, py) = a, b, point
+        dx, dy = bx-ax, by-ay
+        t = max(0, min(1, ((px-ax)*dx + (py-ay)*dy) / (dx*dx + dy*dy))) if dx or dy else 0
+        reach = (self.strokes[id][2] + STROKESLOP)/2
+        return (ax+t*dx-px)**2 + (ay+t*dy-py)**2 <= reach*reach
+    @timings.timed('blit')
+    def blit(self, surface, pos, rect=None):
+        # The strokes traced since the last blit are kept along with their
+        # pixels
+        step = []
+        full = self.blit_step(step, surface, pos, rect)
+        changes = {}
+        for points, color, width in self.traced:
+            id = self.next_id
+            self.index(id, ([sub_tuples(point, pos) for point in points], color, width))
+            changes[id] = self.strokes[id]
+        self.traced = []
+        self.record(step, {id: None for id in changes}, changes)
+        return self.visible_changes(self.commit(step, full))
+    def change(self, changes):
+        # Applies {id: stroke or None} and draws the chunks it crosses again
+        # Returns the (pos, area) that changed
+        step = []
+        before = {id: self.strokes.get(id) for id in changes}
+        cells = set().union(*(self.cells[id] for id in changes if id in self.strokes))
+        for id, stroke in changes.items():
+            self.index(id, stroke)
+        cells.update(*(self.cells[id] for id in changes if id in self.strokes))
+        self.render(step, cells)
+        self.record(step, before, {id: self.strokes.get(id) for id in changes})
+        return self.visible_changes(self.commit(step, cells))
+    def unstroke(self, rect):
+        # Removes the strokes `hit' finds in `rect'
+        return self.change({id: None for id in self.hit(rect)})
+    def restyle(self, point, color, width):
+        # Gives the topmost stroke under `point' another color and width
+        ids = self.hit(pygame.Rect(point, (0,0)))
+        return self.change({id: (self.strokes[id][0], color, width) for id in ids})
+    def render(self, step, cells):
+        cs = self.chunksize
+        for pos in cells:
+            if not self.exists(pos) and pos not in self.grid:
+                continue
+            def draw(chunk, pos=pos):
+                chunk.fill(transparent)
+                for id in sorted(self.grid.get(pos, ())):
+                    points, color, width = self.strokes[id]
+                    draw_lines.__wrapped__(chunk, [(x+pos[0]*cs, y+pos[1]*cs) for x, y in points], color, width)
+            self.edit(pos, pygame.Rect(0,0,cs,cs), step, draw)
+    def record(self, step, before, after):
+        if before or after:
+            step.append((None, None, *(zlib.compress(json.dumps(list(changes.items())).encode(), HISTORYLEVEL) for changes in (before, after))))
+    def visible_changes(self, changed):
+        return [(pos, area) for pos, area in changed if pos is not None]
+    def restore(self, pos, area, data):
+        if pos is not None:
+            return super().restore(pos, area, data)
+        for id, stroke in json.loads(zlib.decompress(data)):
+            self.index(id, stroke)
+    def undo(self):
+        return self.visible_changes(super().undo())
+    def redo(self):
+        return self.visible_changes(super().redo())
+    def erase(self, rect):
+        # Pixels of a stroke cannot be cleared without losing it
+        return self.unstroke(rect)
+    def save_strokes(self):
+        return [(id, *stroke) for id, stroke in self.strokes.items()]
+    def load_strokes(self, strokes):
+        for id, points, color, width in strokes:
+            self.index(id, (points, color, width))
+
+class Clip:
+    # Chunks under `rect' of the board, as surfaces or uniform colors
+    def __init__(self, rect, chunks):
+        self.rect = rect
+        self.chunks = chunks
+    def dump(self):
+        # (rect, chunks) as journaled, each chunk being its color or its
+        # compressed pixels
+        return self.rect, [(pos, chunk if isinstance(chunk, tuple) else base64.b64encode(zlib.compress(pygame.image.tostring(chunk, CSIMGFORMAT), CHUNKLEVEL)).decode()) for pos, chunk in self.chunks.items()]
+    @classmethod
+    def load(cls, rect, chunks, size):
+        return cls(pygame.Rect(rect), {tuple(pos): tuple(chunk) if isinstance(chunk, list) else pygame.image.fromstring(zlib.decompress(base64.b64decode(chunk)), (size,size), CSIMGFORMAT) for pos, chunk in chunks})
+
+class Layers:
+    # Surfaces sharing a chunk grid, by id, drawn from the bottom of `order'
+    # up and leaving out the `hidden' ones; reads like a Surface, whose
+    # chunks would be the composites of the visible layers, each kept until
+    # one of its layers changes there
+    def __init__(self, chunksize):
+        self.chunksize = chunksize
+        self.surfaces = {}
+        self.order = []
+        self.hidden = set()
+        self.stale = set()
+        # shared with the layers, for the pyramid
+        self.store = lambda id: None
+        # store of a layer added empty
+        self.reset()
+    def reset(self):
+        self.composites = ChunkCache(self.chunksize, COMPOSITEMEMORY, None)
+        self.composites.drop = lambda pos: True
+        # rebuilt rather than packed once over budget
+    def add(self, surface, id=None):
+        if id is None:
+            id = max(self.surfaces, default=-1) + 1
+        self.stale.update(surface.stale)
+        surface.stale = self.stale
+        surface.touched = self.invalidate
+        self.surfaces[id] = surface
+        self.order.append(id)
+        for layer in self.surfaces.values():
+            layer.chunks.resize(LAYERMEMORY//len(self.surfaces))
+        return id
+    def get(self, id, vector=False):
+        # The layer `id', added empty if it does not exist yet, keeping its
+        # strokes if `vector' is set
+        if id not in self.surfaces:
+            self.add((StrokeSurface if vector else Surface)(self.chunksize, {}, self.store(id)), id)
+        return self.surfaces[id]
+    def arrange(self, order, hidden, vector=()):
+        for id in order:
+            self.get(id, id in vector)
+        self.order = list(order) + [id for id in self.order if id not in order]
+        self.hidden = set(hidden)
+        self.reset()
+        self.stale.update(*(surface.positions() for surface in self.surfaces.values()))
+    def vector(self):
+        # ids of the layers keeping their strokes
+        return sorted(id for id, surface in self.surfaces.items() if surface.vector)
+    def invalidate(self, pos):
+        if pos in self.composites:
+            del self.composites[pos]
+    def shown(self):
+        return [self.surfaces[id] for id in self.order if id not in self.hidden]
+    def toggle(self, id):
+        # Hides or shows the layer `id'; returns the positions that changed
+        if id in self.hidden:
+            self.hidden.discard(id)
+        else:
+            self.hidden.add(id)
+        return self.changed(self.surfaces[id].positions())
+    def swap(self, i, j):
+        # Swaps the layers at `i' and `j' in `order'; returns the positions
+        # that changed
+        a, b = self.order[i], self.order[j]
+        self.order[i], self.order[j] = b, a
+        if a in self.hidden or b in self.hidden:
+            return set()
+        return self.changed(self.surfaces[a].positions() & self.surfaces[b].positions())
+    def changed(self, positions):
+        for pos in positions:
+            self.invalidate(pos)
+        self.stale.update(positions)
+        return positions
+    @property
+    def stored(self):
+        return set().union(*(surface.stored for surface in self.shown()))
+    def load(self, positions):
+        for surface in self.shown():
+            surface.load([pos for pos in positions if pos in surface.stored])
+    def positions(self):
+        return set().union(*(surface.positions() for surface in self.shown()))
+    def exists(self, pos):
+        return any(surface.exists(pos) for surface in self.shown())
+    def get_chunk(self, pos, write=False):
+        # Composite of the chunks at `pos', False if there is none; a chunk
+        # on a single layer is its own composite
+        if pos in self.composites:
+            return self.composites[pos]
+        chunks = [chunk for chunk in (surface.get_chunk(pos, False) for surface in self.shown()) if chunk]
+        if len(chunks) < 2:
+            return chunks[0] if chunks else False
+        composite = chunks[0].copy()
+        for chunk in chunks[1:]:
+            composite.blit(chunk, (0,0))
+        self.composites[pos] = composite
+        return composite
+    def raw(self, pos):
+        # Pixels of the composite at `pos', without decoding the chunk of a
+        # single layer if it is packed
+        chunks = [surface.chunks for surface in self.shown() if surface.exists(pos)]
+        if len(chunks) == 1 and pos in chunks[0]:
+            return chunks[0].raw(pos)
+        return pygame.image.tostring(self.get_chunk(pos), CSIMGFORMAT)
+    def retrieve_chunks(self, screensize, pos):
+        positions = list(self.visible(screensize, pos))
+        self.load(positions)
+        for pos in positions:
+            chunk = self.get_chunk(pos)
+            if chunk:
+                yield mul_tuple(self.chunksize, pos), chunk
+    bounds = Surface.bounds
+    visible = Surface.visible
+    areas = Surface.areas
+
+class SessionStore:
+    # Append-only pack of encoded chunks, and an index mapping each chunk
+    # position to the (offset, length, format) of its latest version
+    def __init__(self, path, index=CSINDEX, pack=CSPACK, packmask=CSPACKMASK):
+        self.path = path
+        self.indexname = index
+        self.packname = pack
+        self.packmask = packmask
+        self.chunksize = None
+        self.offset = (0,0)
+        self.pack = pack
+        self.journal = 0
+        # journal files up to this one are included in the pack
+        self.index = {}
+        self.reader = None
+        self.lock = threading.Lock()
+        # the writer thread updates the index while the board reads chunks
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, self.indexname))
+    def open(self):
+        with open(os.path.join(self.path, self.indexname)) as file:
+            index = json.load(file)
+        self.chunksize = index['chunksize']
+        self.offset = tuple(index['offset'])
+        self.journal = index.get('journal', 0)
+        with self.lock:
+            self.pack = index.get('pack', self.packname)
+            self.index = {(x,y): (start, length, format) for x, y, start, length, format in index['chunks']}
+            # opened again, the pack may have been compacted since
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+    def read(self, pos):
+        with self.lock:
+            start, length, format = self.index[pos]
+            if self.reader is None:
+                self.reader = open(os.path.join(self.path, self.pack), 'rb')
+            self.reader.seek(start)
+            return self.reader.read(length), format
+    def write(self, chunksize, offset, chunks, removed=(), journal=None):
+        # Appends the encoded `chunks', as pos: (data, format), to the pack,
+        # then commits the index without the `removed' positions
+        self.chunksize = chunksize
+        self.offset = offset
+        if journal is not None:
+            self.journal = journal
+        entries = self.append(self.pack, chunks)
+        with self.lock:
+            self.index.update(entries)
+            for pos in removed:
+                self.index.pop(pos, None)
+        self.commit()
+    def append(self, pack, chunks):
+        with open(os.path.join(self.path, pack), 'ab') as pack:
+            start = pack.tell()
+            entries = {}
+            for pos, (data, format) in chunks.items():
+                pack.write(data)
+                entries[pos] = (start, len(data), format)
+                start += len(data)
+            pack.flush()
+            os.fsync(pack.fileno())
+        return entries
+    def commit(self):
+        index = {
+            'chunksize': self.chunksize,
+            'offset': self.offset,
+            'pack': self.pack,
+            'journal': self.journal,
+            'chunks': [(x, y, start, length, format) for (x,y), (start, length, format) in self.index.items()]
+        }
+        with open(os.path.join(self.path, self.indexname+'.tmp'), 'w') as file:
+            json.dump(index, file)
+        os.replace(os.path.join(self.path, self.indexname+'.tmp'), os.path.join(self.path, self.indexname))
+    def live(self):
+        # Share of the pack taken by the latest version of each chunk
+        pack = os.path.join(self.path, self.pack)
+        size = os.path.getsize(pack) if os.path.isfile(pack) else 0
+        return sum(length for start, length, format in self.index.values())/size if size else 1
+    def compact(self, function=None):
+        # Rewrites the pack with only the latest version of each chunk, in a
+        # new file so that the old index stays valid until the new one is
+        # committed; `function' may rewrite each (pos, data, format) into a
+        # (data, format), or None to drop it
+        # Returns (chunks before, chunks after, bytes before, bytes after)
+        old = self.pack
+        before = os.path.getsize(os.path.join(self.path, old)) if os.path.isfile(os.path.join(self.path, old)) else 0
+        count = len(self.index)
+        chunks = {}
+        for pos in sorted(self.index, key=lambda pos: self.index[pos][0]):
+            data, format = self.read(pos)
+            entry = (data, format) if function is None else function(pos, data, format)
+            if entry is not None:
+                chunks[pos] = entry
+        self.pack = self.packmask.format(n=int(old.split('.')[-1])+1 if old != self.packname else 1)
+        if os.path.isfile(os.path.join(self.path, self.pack)):
+            os.remove(os.path.join(self.path, self.pack))
+        entries = self.append(self.pack, chunks)
+        with self.lock:
+            self.index = entries
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+        self.commit()
+        if os.path.isfile(os.path.join(self.path, old)):
+            os.remove(os.path.join(self.path, old))
+        return count, len(entries), before, os.path.getsize(os.path.join(self.path, self.pack))
+
+class Pyramid:
+    # Copies of each chunk halved MIPLEVELS times, indexed by level (1 for
+    # half size); only those of the level drawn are kept, up to MIPMEMORY
+    # bytes of them, those of a changed chunk being rebuilt when next
+    # needed, and the smaller ones saved with the session read back from
+    # `store'
+    def __init__(self, chunksize, store):
+        self.chunksize = chunksize
+        self.sizes = [-(-chunksize//2**level) for level in range(MIPLEVELS+1)]
+        self.store = store
+        self.level = None
+        self.tiles = {}
+        self.outdated = set()
+        # positions whose tiles in `store' no longer match their chunk
+    def update(self, surface):
+        for pos in surface.stale:
+            if pos in self.tiles:
+                del self.tiles[pos]
+        self.outdated.update(surface.stale)
+        surface.stale.clear()
+    def draw(self, level):
+        # Drops the tiles of the level drawn before
+        if level != self.level:
+            self.level = level
+            self.tiles = ChunkCache(self.sizes[level], MIPMEMORY, None)
+            self.tiles.drop = lambda pos: True
+    def tile(self, pos, level):
+        # None if it has to be built
+        self.draw(level)
+        if pos not in self.tiles and pos not in self.outdated and pos in self.store.index and level >= MIPPERSIST:
+            self.tiles[pos] = self.decode(zlib.decompress(self.store.read(pos)[0]), level)
+        return self.tiles[pos] if pos in self.tiles else None
+    def build(self, pos, chunk):
+        if not chunk:
+            if pos in self.tiles:
+                del self.tiles[pos]
+            return
+        self.tiles[pos] = self.scale(chunk, self.level)[-1]
+    def scale(self, chunk, level):
+        tiles = [chunk]
+        for size in self.sizes[1:level+1]:
+            tiles.append(pygame.transform.smoothscale(tiles[-1], (size,size)))
+        return tiles
+    def raw(self, pos, data):
+        # Pixels of the tiles saved with the session, given those of the chunk
+        tiles = self.scale(pygame.image.fromstring(data, (self.chunksize,self.chunksize), CSIMGFORMAT), MIPLEVELS)
+        self.outdated.discard(pos)
+        return b''.join(pygame.image.tostring(tile, CSIMGFORMAT) for tile in tiles[MIPPERSIST:])
+    def decode(self, data, level):
+        start = 4*sum(size*size for size in self.sizes[MIPPERSIST:level])
+        size = self.sizes[level]
+        return pygame.image.fromstring(data[start:start+size*size*4], (size,size), CSIMGFORMAT)
+
+class Journal:
+    # Append-only log of the operations committed since the last session
+    # save, one JSON record per line, in numbered files so that a save can
+    # remove the ones it includes; appends are buffered, and synced
+    # JOURNALSYNC milliseconds after the first one left unsynced
+    def __init__(self, path, saved):
+        self.path = path
+        self.saved = saved
+        self.generation = max(self.generations() + [saved]) + 1
+        self.file = None
+        self.size = 0
+        self.unsynced = False
+    def generations(self):
+        # Numbers of the journal files not included in the session yet
+        names = os.listdir(self.path) if os.path.isdir(self.path) else []
+        return sorted(n for n in (int(name[len(CSJOURNAL):]) for name in names if name.startswith(CSJOURNAL) and name[len(CSJOURNAL):].isdigit()) if n > self.saved)
+    def filename(self, generation):
+        return os.path.join(self.path, CSJOURNAL + str(generation))
+    def append(self, *record):
+        if self.file is None:
+            self.file = open(self.filename(self.generation), 'a')
+        line = json.dumps(record, default=tuple) + '\n'
+        self.file.write(line)
+        self.size += len(line)
+        if not self.unsynced:
+            self.unsynced = True
+            pygame.time.set_timer(JOURNAL_EVENT, JOURNALSYNC, 1)
+    def sync(self):
+        if self.unsynced and self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.unsynced = False
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.unsynced = False
+    def rotate(self):
+        # Starts a new file; returns the number of the last one
+        self.close()
+        self.size = 0
+        self.generation += 1
+        return self.generation - 1
+    def records(self):
+        # Stops at the first torn record, left by a crash in the middle of
+        # an append
+        for generation in self.generations():
+            with open(self.filename(generation)) as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        return
+    def remove(self, upto):
+        # Removes the journal files included in the session up to `upto'
+        for generation in self.generations():
+            if generation <= upto:
+                os.remove(self.filename(generation))
+        self.saved = max(self.saved, upto)
+
+class Replay:
+    # Applies journaled operations to `surface', drawing through a scratch
+    # surface the way flush does through temp_surf; undo and redo records
+    # carry their pixels, and only move the history of `surface' along if
+    # `history' is set; layer records switch `surface' to one of `layers'
+    def __init__(self, surface, size=SCREENSIZE, history=True, layers=None):
+        self.surface = surface
+        self.history = history
+        self.layers = layers
+        self.layer = 0
+        self.resize(size)
+        self.clip = None
+        self.offset = None
+    def resize(self, size):
+        self.scratch = pygame.Surface(size, SRCALPHA)
+        self.scratch.fill(transparent)
+        self.drawn = pygame.Rect(0,0,0,0)
+        # area of the scratch surface drawn to since the last flush
+    def draw(self, rect):
+        if self.drawn:
+            self.drawn.union_ip(rect)
+        else:
+            self.drawn.update(rect)
+    def flush(self, rect):
+        changed = self.surface.blit(self.scratch, self.offset, rect)
+        self.scratch.fill(transparent, rect)
+        self.drawn.update(0,0,0,0)
+        return changed
+    def apply(self, op, *values):
+        # Returns the (pos, area) that changed
+        surface = self.surface
+        if op == 'draw_lines':
+            points, color, width = values
+            self.draw(draw_lines.__wrapped__(self.scratch, [tuple(point) for point in points], color, width))
+            surface.trace([tuple(point) for point in points], tuple(color), width)
+        elif op == 'fill':
+            pos1, pos2, color = values
+            self.draw(pygame.draw.rect(self.scratch, color, make_rect(pos1, pos2)))
+        elif op == 'flush':
+            self.offset = tuple(values[0])
+            return self.flush(pygame.Rect(values[1]))
+        elif op == 'erase':
+            return surface.erase(pygame.Rect(values[0]))
+        elif op == 'copy':
+            self.clip = surface.copy(pygame.Rect(values[0]))
+        elif op == 'clip':
+            # a clip copied before the journal file started
+            self.clip = Clip.load(*values, surface.chunksize)
+        elif op == 'paste':
+            return surface.paste(self.clip, tuple(values[0]))
+        elif op == 'flood':
+            return surface.flood(tuple(values[0]), tuple(values[1]), FILLLIMIT) or []
+        elif op == 'restyle':
+            return surface.restyle(tuple(values[0]), tuple(values[1]), values[2])
+        elif op in ('undo', 'redo'):
+            # the step may predate the save, so its pixels come along
+            if self.history:
+                getattr(surface.history, op)()
+            # strokes changed by the step come as an entry without position
+            changed = [(pos and tuple(pos), area and pygame.Rect(area)) for pos, area, data in values[0]]
+            for (pos, area), (_, _, data) in zip(changed, values[0]):
+                surface.restore(pos, area, base64.b64decode(data))
+            surface.reclaim(pos for pos, area in changed)
+            return [(pos, area) for pos, area in changed if pos is not None]
+        elif op == 'offset':
+            self.offset = tuple(values[0])
+        elif op == 'view':
+            # a board connecting to a server, with its offset and window size
+            self.resize(tuple(min(max(side, 1), SERVERVIEW) for side in values[1][:2]))
+            self.clip = None
+            self.offset = tuple(values[0])
+        elif op == 'layer' and self.layers is not None:
+            self.layer = values[0]
+            self.surface = self.layers.get(self.layer)
+        elif op == 'layers' and self.layers is not None:
+            self.layers.arrange(*values)
+        return []
+
+class Board:
+    # The board being drawn on: its chunks, where the window is on them,
+    # what was drawn on temp_surf since the last flush and the clip of the
+    # cut/copy/paste tools, with the stores and journal of the session
+    # saved in `path'
+    def __init__(self, path, size=SCREENSIZE):
+        self.path = path
+        self.store = SessionStore(path)
+        self.mipstore = SessionStore(path, MIPINDEX, MIPPACK, MIPPACKMASK)
+        self.journal = None
+        self.pyramid = None
+        self.surface = None
+        self.offset = (0,0)
+        self.temp_surf = pygame.Surface(size, SRCALPHA)
+        self.temp_surf.fill(transparent)
+        self.need_flush = False
+        self.flush_rect = pygame.Rect(0,0,0,0)
+        # area of temp_surf drawn to since the last flush
+        self.buffer = None
+        # the clip of the cut/copy/paste tools
+        self.stores = {0: self.store}
+        self.layers = None
+        self.active = 0
+        # id of the layer drawn on, whose Surface is `surface'
+        self.journaled = 0
+        # layer the journal records since its last rotation apply to
+    def load(self, offset, surface, dirty=()):
+        # Sets the chunks to `surface', as (chunksize, chunks, store), the
+        # way load_cursession returns them, as the only layer
+        self.offset = offset
+        self.surface = Surface(*surface)
+        self.surface.dirty.update(dirty)
+        self.surface.reclaim(dirty)
+        self.layers = Layers(self.surface.chunksize)
+        self.layers.store = self.layer_store
+        self.layers.add(self.surface, 0)
+        self.active = self.journaled = 0
+    def layer_store(self, id):
+        if id not in self.stores:
+            self.stores[id] = SessionStore(self.path, LAYERINDEX.format(id=id), LAYERPACK.format(id=id), LAYERPACKMASK.format(id=id))
+        return self.stores[id]
+    def load_layers(self):
+        # Adds the layers saved with the session above the base one
+        if not os.path.isfile(os.path.join(self.path, LAYERFILE)):
+            return
+        with open(os.path.join(self.path, LAYERFILE)) as file:
+            meta = json.load(file)
+        for id in meta['order']:
+            store = self.layer_store(id)
+            if id == 0 or not store.exists():
+                continue
+            store.open()
+            if store.chunksize != self.surface.chunksize:
+                print('Error while trying to restore layer %s: chunk size %s instead of %s' % (id, store.chunksize, self.surface.chunksize))
+                continue
+            surface = self.layers.get(id, id in meta.get('vector', ()))
+            if surface.vector:
+                with open(os.path.join(self.path, LAYERSTROKES.format(id=id))) as file:
+                    surface.load_strokes(json.load(file))
+        self.layers.order = [id for id in meta['order'] if id in self.layers.surfaces]
+        self.layers.hidden = set(meta['hidden']).intersection(self.layers.order)
+    def select(self, id):
+        self.active = id
+        self.surface = self.layers.get(id)
+
+class Writer:
+    # Runs save jobs one after the other on a background thread, and reports
+    # their progress and completion to the main loop through WRITER_EVENT
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.last = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def submit(self, label, function, *args, failed=None):
+        # `function' is called as function(progress, *args), and `failed'
+        # is called on the main thread if it raises
+        self.jobs.put((label, function, args, failed))
+    def run(self):
+        while True:
+            label, function, args, failed = self.jobs.get()
+            self.last = 0
+            def progress(done, total):
+                if time.perf_counter() - self.last > WRITERPROGRESS:
+                    self.last = time.perf_counter()
+                    pygame.event.post(pygame.event.Event(WRITER_EVENT, label=label, done=done, total=total))
+            try:
+                result, error = function(progress, *args), None
+            except Exception as e:
+                result, error = None, e
+            pygame.event.post(pygame.event.Event(WRITER_EVENT, label=label, result=result, error=error, failed=failed))
+            self.jobs.task_done()
+    @property
+    def pending(self):
+        return self.jobs.unfinished_tasks
+    def join(self):
+        self.jobs.join()
+
+class RemoteClient:
+    # A board connected to the server, with the chunks of its view it has
+    # not been sent since they last changed
+    def __init__(self, id, writer, surface):
+        self.id = id
+        self.writer = writer
+        self.replay = Replay(surface, (0,0), history=False)
+        self.view = set()
+        self.pending = set()
+        import asyncio
+        self.wake = asyncio.Event()
+
+class BoardServer:
+    # Owns the board of the boards connected to it: their operations are
+    # applied in the order they come, SERVERTICK milliseconds at a time so
+    # that the strokes of a tick are flushed as one, then each client is sent
+    # the chunks of its view that changed; a client reading slower than the
+    # board changes only gets the latest version of each chunk, and a full
+    # queue of operations stops reading from the clients
+    def __init__(self, surface, journal):
+        self.surface = surface
+        self.journal = journal
+        self.clients = set()
+        self.ops = None
+        self.messages = collections.OrderedDict()
+        # encoded chunks by position, until they change
+        self.ids = itertools.count(1)
+        self.stats = {'clients': 0, 'ops': 0, 'ticks': 0, 'chunks': 0, 'bytes': 0}
+    async def start(self, host, port):
+        import asyncio
+        self.ops = asyncio.Queue(SERVERQUEUE)
+        return await asyncio.start_server(self.handle, host, port, limit=SERVERLINE)
+    async def run(self):
+        import asyncio
+        while True:
+            await asyncio.sleep(SERVERTICK/1000)
+            self.tick()
+    async def handle(self, reader, writer):
+        import asyncio
+        client = RemoteClient(next(self.ids), writer, self.surface)
+        self.clients.add(client)
+        self.stats['clients'] += 1
+        sender = asyncio.ensure_future(self.send(client))
+        try:
+            writer.write(self.encode('hello', self.surface.chunksize))
+            async for line in reader:
+                record = json.loads(line)
+                if isinstance(record, list) and record[:1] == ['view'] and not self.viewable(record):
+                    raise ValueError('window size not within %sx%s' % (SERVERVIEW, SERVERVIEW))
+                await self.ops.put((client, record))
+        except ConnectionError:
+            pass
+        except ValueError as e:
+            print('Dropped client %s: %s' % (client.id, e))
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            writer.close()
+    @staticmethod
+    def viewable(record):
+        # Whether the window size of a view record is one the board can draw
+        size = record[2] if len(record) > 2 else None
+        return isinstance(size, list) and len(size) == 2 and all(isinstance(side, int) and 0 < side <= SERVERVIEW for side in size)
+    async def send(self, client):
+        try:
+            while True:
+                await client.wake.wait()
+                client.wake.clear()
+                while client.pending:
+                    message = self.message(client.pending.pop())
+                    client.writer.write(message)
+                    self.stats['chunks'] += 1
+                    self.stats['bytes'] += len(message)
+                    await client.writer.drain()
+        except ConnectionError:
+            pass
+    def tick(self):
+        changed = set()
+        drawing = set()
+        for i in range(self.ops.qsize()):
+            client, record = self.ops.get_nowait()
+            changed.update(self.apply(client, record))
+            drawing.add(client)
+        # strokes are shown while they are drawn, not when the pen is lifted
+        for client in drawing:
+            replay = client.replay
+            if replay.drawn and replay.offset is not None:
+                changed.update(self.apply(client, ['flush', replay.offset, replay.drawn]))
+        self.publish(changed)
+        self.stats['ticks'] += 1
+    def apply(self, client, record):
+        # Returns the positions of the chunks that changed; the pixels of an
+        # undo step would be written over the ink of the other clients
+        if record[:1] in (['undo'], ['redo']):
+            print('Ignored %s from client %s' % (record[0], client.id))
+            return []
+        try:
+            changed = client.replay.apply(*record)
+        except Exception as e:
+            print('Ignored %s from client %s: %s' % (str(record)[:40], client.id, e))
+            return []
+        self.journal.append('client', client.id, record)
+        self.stats['ops'] += 1
+        if record[0] in ('view', 'offset'):
+            self.watch(client)
+        return [pos for pos, area in changed]
+    def watch(self, client):
+        # Sends the chunks coming into the view of `client'
+        replay = client.replay
+        view = set(self.surface.visible(replay.scratch.get_size(), replay.offset))
+        client.pending.update(view.difference(client.view))
+        client.view = view
+        client.wake.set()
+    def publish(self, changed):
+        for pos in changed:
+            self.messages.pop(pos, None)
+        for client in self.clients:
+            client.pending.update(client.view.intersection(changed))
+            if client.pending:
+                client.wake.set()
+    def message(self, pos):
+        # The chunk at `pos' as sent to the clients: its pixels compressed,
+        # its color if it is uniform, or None if it is empty
+        if pos in self.messages:
+            self.messages.move_to_end(pos)
+            return self.messages[pos]
+        surface = self.surface
+        if pos in surface.stored:
+            surface.load([pos])
+        if pos in surface.uniform:
+            value = surface.uniform[pos]
+        elif pos in surface.chunks:
+            value = base64.b64encode(zlib.compress(surface.chunks.raw(pos), CHUNKLEVEL)).decode()
+        else:
+            value = None
+        self.messages[pos] = self.encode('chunk', pos, value)
+        if len(self.messages) > SERVERCACHE:
+            self.messages.popitem(last=False)
+        return self.messages[pos]
+    @staticmethod
+    def encode(*record):
+        return (json.dumps(record, default=tuple) + '\n').encode()
+
+class Link:
+    # Connection of the board to a board server; operations are sent from a
+    # thread so that a slow server never holds up drawing, and the chunks it
+    # sends come back decompressed as NET_EVENT, or one without a chunk once
+    # the connection is lost
+    def __init__(self, address):
+        self.socket = socket.create_connection(address)
+        self.file = self.socket.makefile('rb')
+        op, self.chunksize = json.loads(self.file.readline())
+        self.out = queue.Queue()
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.writer = threading.Thread(target=self.write, daemon=True)
+    def start(self):
+        self.reader.start()
+        self.writer.start()
+    def send(self, *record):
+        self.out.put(BoardServer.encode(*record))
+    def read(self):
+        try:
+            for line in self.file:
+                op, pos, value = json.loads(line)
+                if isinstance(value, str):
+                    value = zlib.decompress(base64.b64decode(value))
+                pygame.event.post(pygame.event.Event(NET_EVENT, chunk=tuple(pos), value=value))
+        except (OSError, ValueError, zlib.error) as e:
+            print('Error while reading from the server: %s' % e)
+        pygame.event.post(pygame.event.Event(NET_EVENT, chunk=None, value=None))
+    def write(self):
+        while True:
+            data = self.out.get()
+            if data is None:
+                return
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                return
+    def close(self):
+        self.out.put(None)
+        if self.writer.is_alive():
+            self.writer.join()
+        self.socket.close()
+
+class TileServer:
+    # Tiles of a saved session for map viewers: tile (x, y) at level z covers
+    # the board from chunksize*2**z*(x, y), as large again, drawn at 1:2**z;
+    # the ETag of a tile is that of the stored chunks it is made of, so that
+    # viewers revalidate it without it being drawn, and tiles are only
+    # encoded when first requested, then kept by ETag in an LRU of `budget'
+    # bytes; the visible layers of the session are drawn from the bottom up
+    def __init__(self, path, budget=TILECACHE):
+        self.store = SessionStore(path)
+        self.stores = [self.store]
+        self.mips = SessionStore(path, MIPINDEX, MIPPACK, MIPPACKMASK)
+        self.mtime = None
+        self.budget = budget
+        self.cache = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'hits': 0, 'misses': 0, 'unchanged': 0}
+    def refresh(self):
+        # Opens the session again once a board or a board server saved it,
+        # into new stores replacing the others at once, so that requests
+        # being served go on with the session as it was
+        path = self.store.path
+        mtime = os.stat(os.path.join(path, self.store.indexname)).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            # another request may have opened it while this one waited
+            mtime = os.stat(os.path.join(path, self.store.indexname)).st_mtime_ns
+            if mtime == self.mtime:
+                return
+            store = SessionStore(path)
+            store.open()
+            stores = [store]
+            if os.path.isfile(os.path.join(path, LAYERFILE)):
+                with open(os.path.join(path, LAYERFILE)) as file:
+                    meta = json.load(file)
+                ids = [id for id in meta['order'] if id not in meta['hidden']]
+                stores = [store if id == 0 else SessionStore(path, LAYERINDEX.format(id=id), LAYERPACK.format(id=id), LAYERPACKMASK.format(id=id)) for id in ids]
+                stores = [layer for layer in stores if layer is store or layer.exists()]
+                for layer in stores:
+                    if layer is not store:
+                        layer.open()
+            mips = SessionStore(path, MIPINDEX, MIPPACK, MIPPACKMASK)
+            if mips.exists():
+                mips.open()
+            if mips.chunksize != store.chunksize:
+                mips.index = {}
+            sizes = [-(-store.chunksize//2**level) for level in range(MIPLEVELS+1)]
+            self.store, self.stores, self.mips, self.sizes, self.mtime = store, stores, mips, sizes, mtime
+    def count(self, name):
+        # Request handlers run on threads of their own
+        with self.lock:
+            self.stats[name] += 1
+    def bounds(self):
+        # Board rectangle covering every chunk, as Surface.bounds
+        positions = set().union(*(store.index for store in self.stores))
+        if not positions:
+            return pygame.Rect(0,0,0,0)
+        cs = self.store.chunksize
+        bounds = pygame.Rect(-max(x for x, y in positions)*cs, -max(y for x, y in positions)*cs, 0, 0)
+        bounds.union_ip(pygame.Rect(-min(x for x, y in positions)*cs, -min(y for x, y in positions)*cs, cs, cs))
+        return bounds
+    def etag(self, level, x, y):
+        # None if the tile has no chunk
+        n = 2**level
+        positions = [(-i, -j) for i in range(x*n, x*n+n) for j in range(y*n, y*n+n)]
+        entries = [(store.pack, [(pos, store.index[pos]) for pos in positions if pos in store.index]) for store in self.stores]
+        if not any(chunks for pack, chunks in entries):
+            return None
+        return hashlib.blake2b(repr((level, x, y, entries)).encode(), digest_size=12).hexdigest()
+    def tile(self, level, x, y, etag):
+        # PNG of the tile whose ETag is `etag'
+        with self.lock:
+            if etag in self.cache:
+                self.stats['hits'] += 1
+                self.cache.move_to_end(etag)
+                return self.cache[etag]
+            self.stats['misses'] += 1
+        data = self.render(level, x, y)
+        with self.lock:
+            if etag not in self.cache:
+                self.cache[etag] = data
+                self.size += len(data)
+            while self.size > self.budget and len(self.cache) > 1:
+                self.size -= len(self.cache.popitem(last=False)[1])
+        return data
+    def render(self, level, x, y):
+        cs = self.store.chunksize
+        n = 2**level
+        if level == 0 and len(self.stores) == 1:
+            data, format = self.stores[0].read((-x, -y))
+            if format == 'png':
+                # the chunk is the tile
+                return data
+        from PIL import Image
+        tile = Image.new(CSIMGFORMAT, (cs,cs), transparent)
+        for i in range(n):
+            for j in range(n):
+                if any((-x*n-i, -y*n-j) in store.index for store in self.stores):
+                    tile.paste(self.chunk((-x*n-i, -y*n-j), level), ((i*cs)>>level, (j*cs)>>level))
+        data = io.BytesIO()
+        tile.save(data, 'png', compress_level=TILELEVEL)
+        return data.getvalue()
+    def chunk(self, pos, level):
+        # PIL image of the chunk at `pos' at 1:2**level, from the overview
+        # saved with the session where it can, else from its layers
+        from PIL import Image
+        size = self.sizes[level]
+        if level >= MIPPERSIST and pos in self.mips.index:
+            start = 4*sum(size*size for size in self.sizes[MIPPERSIST:level])
+            return Image.frombytes(CSIMGFORMAT, (size,size), zlib.decompress(self.mips.read(pos)[0])[start:start+4*size*size])
+        images = [self.layer(store, pos, level) for store in self.stores if pos in store.index]
+        image = images[0]
+        for layer in images[1:]:
+            image = Image.alpha_composite(image, layer)
+        return image
+    def layer(self, store, pos, level):
+        from PIL import Image
+        size = self.sizes[level]
+        data, format = store.read(pos)
+        if format == CSUNIFORM:
+            return Image.new(CSIMGFORMAT, (size,size), tuple(data))
+        image = Image.frombytes(CSIMGFORMAT, (self.store.chunksize,)*2, decode_chunk(data, format))
+        return image.reduce(2**level) if level else image
+
+class TileHandler:
+    # Serves the viewer at / and the tiles at /Z/X/Y.png, Z going from 0 for
+    # 1:1 down to -MIPLEVELS, as the request handler of tile_server
+    protocol_version = 'HTTP/1.1'
+    # headers and tiles are written apart, the tile must not wait for an ACK
+    disable_nagle_algorithm = True
+    def do_GET(self):
+        tiles = self.server.tiles
+        tiles.count('requests')
+        try:
+            tiles.refresh()
+        except (OSError, ValueError) as e:
+            return self.reply(503, str(e).encode(), 'text/plain')
+        path = self.path.split('?')[0]
+        if path == '/':
+            return self.reply(200, tile_viewer(tiles).encode(), 'text/html; charset=utf-8')
+        match = re.fullmatch(r'/(-?\d+)/(-?\d+)/(-?\d+)\.png', path)
+        if not match or not -MIPLEVELS <= int(match[1]) <= 0:
+            return self.reply(404)
+        level, x, y = -int(match[1]), int(match[2]), int(match[3])
+        etag = tiles.etag(level, x, y)
+        if etag is None:
+            return self.reply(404)
+        if '"%s"' % etag in self.headers.get('If-None-Match', ''):
+            tiles.count('unchanged')
+            return self.reply(304, etag=etag)
+        self.reply(200, tiles.tile(level, x, y, etag), 'image/png', etag)
+    def reply(self, code, data=b'', type=None, etag=None):
+        self.send_response(code)
+        if type is not None:
+            self.send_header('Content-Type', type)
+        if etag is not None:
+            self.send_header('ETag', '"%s"' % etag)
+            # viewers revalidate, and see the session saved again
+            self.send_header('Cache-Control', 'no-cache')
+        if code != 304:
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if code != 304:
+            self.wfile.write(data)
+    def log_message(self, format, *args):
+        # a line per tile would drown the rest
+        pass
 
 class Lock:
     def __init__(self):
+        # the tool is shown once the window opens
         self._lock = None
-        self.lock = None
     @property
     def lock(self):
         return self._lock
@@ -223,38 +1926,285 @@ class Hitbox:
 #################
 
 def undo():
+    if link is not None:
+        popup('undo is off on a board shared by a server')
+        return
     flush()
-    surface.undo()
+    if board.surface.history.undos:
+        journal_op('undo', [(pos, area, base64.b64encode(before).decode()) for pos, area, before, after in reversed(board.surface.history.undos[-1])])
+    for pos, area in board.surface.undo():
+        damage(chunk_rect(pos, area))
+    show_history()
     popup('undo')
 
+def redo():
+    if link is not None:
+        popup('undo is off on a board shared by a server')
+        return
+    flush()
+    if board.surface.history.redos:
+        journal_op('redo', [(pos, area, base64.b64encode(after).decode()) for pos, area, before, after in board.surface.history.redos[-1]])
+    for pos, area in board.surface.redo():
+        damage(chunk_rect(pos, area))
+    show_history()
+    popup('redo')
+
+def chunk_rect(pos, area):
+    # Screen rectangle of `area' of the chunk at `pos'
+    return area.move(sub_tuples(board.offset, mul_tuple(board.surface.chunksize, pos)))
+
+def show_history():
+    if not debug:
+        return
+    history = board.surface.history
+    chunks = board.surface.chunks
+    lines = [
+        'chunks: %s decoded, %s packed, %s stored, %s hits, %s misses, %s evictions, %s drops' % (len(chunks.resident), len(chunks.packed), len(board.surface.stored), *chunks.stats.values()),
+        'history: %s undo, %s redo, %.1f/%.0f KB' % (len(history.undos), len(history.redos), history.size/1024, history.budget/1024)
+    ]
+    for i in range(len(history.undos)-1, max(len(history.undos)-DEBUGSTEPS, 0)-1, -1):
+        step = history.undos[i]
+        lines.append('#%s: %s chunks, %.1f KB' % (i+1, len(step), history.step_size(step)/1024))
+    debug_surface.fill(white)
+    for i, line in enumerate(lines):
+        debug_surface.blit(font.render(line, True, black), (2, 2+i*fontsize))
+    pygame.draw.rect(debug_surface, grey, pygame.Rect(0,0,debug_surface.get_width(),debug_surface.get_height()),3)
+    damage(debug_surface.get_rect(topleft=debug_pos))
+
+def toggle_debug():
+    global debug
+    debug = not debug
+    damage(debug_surface.get_rect(topleft=debug_pos))
+    show_history()
+
+# Profiler
+# ********
+def end_frame():
+    frame = timings.end_frame()
+    profile_out.write(json.dumps({'frame': idle_stats['frames'], 'ms': {name: round(1000*t, 3) for name, t in frame.items()}}) + '\n')
+    if profiling and idle_stats['frames'] % PROFILEREFRESH == 0:
+        show_profile()
+
+def show_profile():
+    # Rolling percentiles of the time spent per frame, in columns
+    lines = [('ms', 'p50', 'p95', 'p99')]
+    for name in sorted(timings.window, key=lambda name: (name != 'frame', name))[:PROFILELINES-1]:
+        lines.append((name, *('%.2f' % (1000*t) for t in timings.percentiles(name))))
+    width = profile_surface.get_width()//5
+    profile_surface.fill(white)
+    for i, line in enumerate(lines):
+        for j, cell in enumerate(line):
+            profile_surface.blit(font.render(cell, True, black), (2+j*width+(width if j else 0), 2+i*fontsize))
+    pygame.draw.rect(profile_surface, grey, profile_surface.get_rect(), 3)
+    damage(profile_surface.get_rect(topleft=profile_pos))
+
+def toggle_profile():
+    global profiling
+    if not PROFILE:
+        popup('profiler off, start with --profile LOG')
+        return
+    profiling = not profiling
+    damage(profile_surface.get_rect(topleft=profile_pos))
+    show_profile()
+
 # Session handling
 # ****************
-def add_file_archive(archive, name, string):
-    s = io.BytesIO(string)
-    tar_info = tarfile.TarInfo(name=name)
-    tar_info.size = len(string)
-    archive.addfile(tarinfo=tar_info, fileobj=s)
-
-def save_chunk(surface, format, size):
-    data = pygame.image.tostring(surface, CSIMGFORMAT)
+def encode_chunk(data, format, size):
     if format == 'string':
         return data
-    img = Image.frombytes(CSIMGFORMAT, (size,size), data)
+    # PIL reads the pixels in place
+    from PIL import Image
+    img = Image.frombuffer(CSIMGFORMAT, (size,size), data, 'raw', CSIMGFORMAT, 0, 1)
+    if format in CSOPAQUE:
+        img = flatten(img)
     zdata = io.BytesIO()
     img.save(zdata, format)
     return zdata.getvalue()
+
+def flatten(img):
+    # RGB image of `img' on the white of the board
+    from PIL import Image
+    return Image.alpha_composite(Image.new(CSIMGFORMAT, img.size, white), img).convert('RGB')
     
+@timings.timed('save')
 def save_cursession():
+    # Only writes the chunks modified since the last save; pixels are copied
+    # here, encoding and writing happen on the writer thread
+    if link is not None:
+        popup('the session is saved by the server')
+        return
     flush()
-    cs, chunks = surface.save()
-    format = FORMAT
-    with tarfile.open(os.path.join(BASEDIR, SESSION, CSFILE), CSARCHWMODE) as archive:
-        add_file_archive(archive, 'chunksize', bytes(str(cs), 'utf-8'))
-        add_file_archive(archive, 'offset', bytes(str(offset), 'utf-8'))
-        add_file_archive(archive, 'format', bytes(format, 'utf-8'))
-        for (x,y), chunk in chunks.items():
-            add_file_archive(archive, CSCHUNKMASK.format(x=x,y=y), save_chunk(chunk, format, cs))
-    popup('saved current session')
+    layers = {}
+    # (store, raw, uniform, removed, strokes) of each layer, the strokes of a
+    # stroke layer being rewritten whole when any of its chunks changed
+    for id, surface in board.layers.surfaces.items():
+        cs, chunks = surface.save()
+        raw = {pos: chunks.raw(pos) for pos in surface.dirty if pos in chunks}
+        uniform = {pos: (bytes(surface.uniform[pos]), CSUNIFORM) for pos in surface.dirty if pos in surface.uniform}
+        strokes = None
+        if surface.vector and (surface.dirty or not os.path.isfile(os.path.join(board.path, LAYERSTROKES.format(id=id)))):
+            strokes = surface.save_strokes()
+        layers[id] = (board.layer_store(id), raw, uniform, surface.dirty.difference(raw, uniform), strokes)
+    dirty = {id: set(surface.dirty) for id, surface in board.layers.surfaces.items()}
+    # overview tiles are made from the composites, and kept for those
+    # holding pixels rather than single colors
+    board.pyramid.update(board.layers)
+    outdated = board.pyramid.outdated.union(*dirty.values())
+    board.layers.load(outdated)
+    mips = {}
+    blank = set()
+    for pos in outdated:
+        if any(pos in surface.chunks for surface in board.layers.shown()):
+            mips[pos] = board.pyramid.raw(pos, board.layers.raw(pos))
+        else:
+            blank.add(pos)
+    for surface in board.layers.surfaces.values():
+        surface.dirty.clear()
+    def failed():
+        for id, positions in dirty.items():
+            board.layers.surfaces[id].dirty.update(positions)
+        board.pyramid.outdated.update(mips)
+    meta = None
+    if len(board.layers.order) > 1 or os.path.isfile(os.path.join(board.path, LAYERFILE)):
+        meta = {'order': list(board.layers.order), 'hidden': sorted(board.layers.hidden), 'vector': board.layers.vector()}
+    generation = board.journal.rotate()
+    # the next journal file starts without a layer record, but with the
+    # clips a paste may still need, their copy being in the files removed
+    board.journaled = 0 if len(board.layers.order) == 1 else None
+    if board.buffer is not None:
+        board.journal.append('clip', *board.buffer.dump())
+    if server is not None:
+        for client in server.clients:
+            if client.replay.clip is not None:
+                board.journal.append('client', client.id, ['clip', *client.replay.clip.dump()])
+    writer.submit('saving current session', write_cursession, cs, board.offset, layers, FORMAT, mips, blank, meta, generation, failed=failed)
+
+@timings.timed('write')
+def write_cursession(progress, cs, offset, layers, format, mips, blank, meta, generation):
+    # The base layer goes last, as its index records the journal files the
+    # session includes
+    written = removals = 0
+    for id in sorted(layers, key=lambda id: id == 0):
+        store, raw, uniform, removed, strokes = layers[id]
+        encoded = dict(uniform)
+        for i, (pos, data) in enumerate(zip(raw, map_chunks(encode_chunk, raw.values(), itertools.repeat(format), itertools.repeat(cs), parallel=format in CSPOOLFORMATS))):
+            progress(i, len(raw))
+            encoded[pos] = (data, format)
+        if id == 0 and meta is not None:
+            with open(os.path.join(board.path, LAYERFILE+'.tmp'), 'w') as file:
+                json.dump(meta, file)
+            os.replace(os.path.join(board.path, LAYERFILE+'.tmp'), os.path.join(board.path, LAYERFILE))
+        if strokes is not None:
+            path = os.path.join(board.path, LAYERSTROKES.format(id=id))
+            with open(path+'.tmp', 'w') as file:
+                json.dump(strokes, file)
+            os.replace(path+'.tmp', path)
+        store.write(cs, offset, encoded, removed, generation if id == 0 else None)
+        written += len(encoded)
+        removals += len(removed)
+    board.journal.remove(generation)
+    # overview tiles go after the chunks they were made from
+    board.mipstore.write(cs, offset, {pos: (zlib.compress(data, CHUNKLEVEL), MIPFORMAT) for pos, data in mips.items()}, blank)
+    # packs mostly made of superseded versions are rewritten as they are,
+    # without dropping any chunk the board may still read
+    compacted = 0
+    for store in [layers[id][0] for id in layers] + [board.mipstore]:
+        if store.live() < CSCOMPACT:
+            store.compact()
+            compacted += 1
+    return 'saved current session (%s chunks, %s removed%s)' % (written, removals, ', %s packs compacted' % compacted if compacted else '')
+
+def compact_cursession(target=None):
+    # Drops superseded, empty and uniform chunks from the session pack,
+    # keeping uniform ones as a single color, and re-encodes the others
+    # into `target' if given; returns what it did, line by line
+    name = os.path.basename(board.store.path)
+    if not board.store.exists():
+        return ['No current session to compact for %s' % name]
+    stores = session_stores()
+    lines = []
+    for id, store in stores.items():
+        count, left, before, after = store.compact(lambda pos, data, format: recode_chunk(data, format, store.chunksize, target))
+        lines.append('Compacted %s%s: %s chunks -> %s chunks, %s bytes -> %s bytes' % (name, ' layer %s' % id if id else '', count, left, before, after))
+    if board.mipstore.exists():
+        board.mipstore.open()
+        count, left, before, after = board.mipstore.compact(lambda pos, data, format: (data, format) if any(pos in store.index and store.index[pos][2] != CSUNIFORM for store in stores.values()) else None)
+        lines.append('Compacted %s overview: %s tiles -> %s tiles, %s bytes -> %s bytes' % (name, count, left, before, after))
+    return lines
+
+def session_stores():
+    # Opened stores of the layers saved with the session, by id, the base
+    # one first
+    ids = [0]
+    if os.path.isfile(os.path.join(board.path, LAYERFILE)):
+        with open(os.path.join(board.path, LAYERFILE)) as file:
+            ids += [id for id in json.load(file)['order'] if id != 0]
+    stores = {id: board.layer_store(id) for id in ids if board.layer_store(id).exists()}
+    for store in stores.values():
+        store.open()
+    return stores
+
+def recode_chunk(data, format, size, target=None):
+    # (data, format) of a stored chunk, re-encoded into `target' if given,
+    # as a single color if it is uniform, None if it is empty
+    if format == CSUNIFORM:
+        return None if not data[3] else (data, format)
+    raw = decode_chunk(data, format)
+    color = raw_color(raw)
+    if color is None:
+        return (data, format) if target in (None, format) else (encode_chunk(raw, target, size), target)
+    elif color[3]:
+        return bytes(color), CSUNIFORM
+    return None
+
+def load_pyramid():
+    # Overview tiles saved with the session, unless made for other chunks
+    try:
+        if board.mipstore.exists():
+            board.mipstore.open()
+    except Exception as e:
+        print('Error while trying to restore the overview: %s' % e)
+    if board.mipstore.chunksize != board.surface.chunksize:
+        board.mipstore.index = {}
+    return Pyramid(board.surface.chunksize, board.mipstore)
+
+def autosave():
+    if link is None and (any(surface.dirty for surface in board.layers.surfaces.values()) or board.store.offset != board.offset):
+        save_cursession()
+
+def journal_event():
+    board.journal.sync()
+    if board.journal.size > JOURNALLIMIT:
+        save_cursession()
+
+def replay_journal():
+    # Applies the operations journaled since the session was last saved,
+    # those of each client of a board server through a Replay of its own
+    # Returns the number of operations
+    replay = Replay(board.surface, layers=board.layers)
+    clients = collections.defaultdict(lambda: Replay(board.layers.get(0), (0,0), history=False))
+    count = 0
+    for op, *values in board.journal.records():
+        if op == 'client':
+            clients[values[0]].apply(*values[1])
+        else:
+            replay.apply(op, *values)
+        count += 1
+    if replay.offset is not None:
+        board.offset = replay.offset
+    board.select(replay.layer)
+    board.journaled = replay.layer
+    return count
+
+def journal_op(*record):
+    # Boards connected to a server journal there instead
+    if link is not None:
+        link.send(*record)
+        return
+    if board.active != board.journaled:
+        board.journal.append('layer', board.active)
+        board.journaled = board.active
+    board.journal.append(*record)
 
 def read_var(var, files, archive, default=None,type=eval):
     if var not in files and default!=None:
@@ -264,46 +2214,380 @@ def read_var(var, files, archive, default=None,type=eval):
     files.remove(var)
     return type(archive.extractfile(var).read())
 
+def raw_color(data):
+    # Same as backend.color, on RGBA pixels
+    if data[3::4].count(0) == len(data)//4:
+        return transparent
+    if data != data[:4]*(len(data)//4):
+        return None
+    return tuple(data[:4])
+
 def load_chunk(string, size, format):
+    return pygame.image.fromstring(decode_chunk(string, format), (size,size), CSIMGFORMAT)
+
+def decode_chunk(string, format):
     if format == 'string':
-        r = pygame.image.fromstring(string, (size,size), CSIMGFORMAT)
-    else:
-        zdata = io.BytesIO(string)
-        img = Image.open(zdata)
-        r = pygame.image.fromstring(img.tobytes(), (size,size), CSIMGFORMAT)
-    r.set_colorkey(white)
-    return r
-    
+        return string
+    from PIL import Image
+    zdata = io.BytesIO(string)
+    img = Image.open(zdata)
+    if img.mode != CSIMGFORMAT:
+        img = img.convert(CSIMGFORMAT)
+    return img.tobytes()
+
+@timings.timed('decode')
+def load_chunks(strings, size, formats, parallel=None):
+    # Decodes in the chunk pool, but only the main thread makes surfaces
+    if parallel is None:
+        parallel = not CSPOOLFORMATS.isdisjoint(formats)
+    return [pygame.image.fromstring(data, (size,size), CSIMGFORMAT) for data in map_chunks(decode_chunk, strings, formats, parallel=parallel)]
     
+@timings.timed('load')
 def load_cursession():
+    # Returns offset, (chunksize, chunks, store), dirty
     try:
-        if os.path.isfile(os.path.join(BASEDIR, SESSION, CSFILE)) and tarfile.is_tarfile(os.path.join(BASEDIR, SESSION, CSFILE)):
-            #print(os.path.join(BASEDIR,SESSION,CSFILE))
-            with tarfile.open(os.path.join(BASEDIR,SESSION,CSFILE), CSARCHRMODE) as archive:
-                files = archive.getnames()
-                cs = read_var('chunksize', files, archive)
-                offset = read_var('offset', files, archive, default=(0,0))
-                format = read_var('format', files, archive, default='string',type=lambda x: x.decode('utf-8'))
-                chunks = {}
-                for file in files:
-                    coords = tuple(int(e) for e in file.split('.')[:2])
-                    string = archive.extractfile(file).read()
-                    chunk = load_chunk(string, cs, format)
-                    chunks[coords] = chunk
-            return offset, (cs, chunks)
-        else:
-            return (0,0), (args.chunk_size, {})
+        return read_cursession(board.store)
     except BaseException as e:
         print('Error while trying to restore session: %s' % e)
-        return (0,0), (args.chunk_size, {})
+        return (0,0), (args.chunk_size, {}, board.store), set()
+
+def read_cursession(store):
+    # Same as load_cursession, for the session of `store', raising errors;
+    # chunks saved in the store are only decoded when first shown, and the
+    # store comes along even before anything is saved in it, so that chunks
+    # evicted once saved are dropped and read back from it
+    if store.exists():
+        store.open()
+        return store.offset, (store.chunksize, {}, store), set()
+    elif os.path.isfile(os.path.join(store.path, CSFILE)) and tarfile.is_tarfile(os.path.join(store.path, CSFILE)):
+        # Sessions saved before the pack format are migrated on next save
+        with tarfile.open(os.path.join(store.path, CSFILE), CSARCHRMODE) as archive:
+            files = archive.getnames()
+            cs = read_var('chunksize', files, archive)
+            offset = read_var('offset', files, archive, default=(0,0))
+            format = read_var('format', files, archive, default='string',type=lambda x: x.decode('utf-8'))
+            coords = [tuple(int(e) for e in file.split('.')[:2]) for file in files]
+            strings = [archive.extractfile(file).read() for file in files]
+            chunks = dict(zip(coords, load_chunks(strings, cs, [format]*len(strings))))
+        return offset, (cs, chunks, store), set(chunks)
+    else:
+        return (0,0), (args.chunk_size, {}, store), set()
     
+# Chunk pool
+# **********
+def get_pool():
+    # Created once, by whichever of the board and the writer thread first
+    # needs it
+    global pool
+    with pool_lock:
+        if pool is None:
+            import concurrent.futures
+            pool = concurrent.futures.ProcessPoolExecutor(WORKERS, mp_context=pool_context())
+    return pool
+
+def pool_context():
+    # Worker processes are spawned from a fresh interpreter, as a fork of
+    # the board would copy the locks of its threads in whatever state they
+    # are; they import this module again, with the arguments of the board
+    # but without running main(), which a fork server would have imported
+    # once, before it was given any
+    import multiprocessing
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    # the workers do not greet again
+    return multiprocessing.get_context('spawn')
+
+def map_chunks(function, items, *args, parallel=True):
+    # Same as map(function, items, *args), fanned out over the chunk pool;
+    # results come back in order
+    items = list(items)
+    if not parallel or WORKERS <= 1 or len(items) < 2:
+        return map(function, items, *args)
+    return get_pool().map(function, items, *args, chunksize=max(1, len(items)//(4*WORKERS)))
+
 # Quit
 # ****
 def quit(exitcode=0):
     if CSPERSISTANCE: save_cursession()
+    if writer.pending:
+        popup('waiting for %s pending saves...' % writer.pending)
+        render()
+    writer.join()
+    board.journal.close()
+    if not CSPERSISTANCE: board.journal.remove(board.journal.generation)
+    if link is not None: link.close()
+    if pool is not None: pool.shutdown()
+    if RECORD: trace_out.close()
+    if PROFILE: profile_out.close()
+    if REPLAY: replay_report()
+    if STATS: print_stats()
     pygame.quit()
     sys.exit(exitcode)
 
+def peak_rss():
+    # In bytes, 0 where the resource module is missing
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+# Board server
+# ************
+def parse_address(address, host=None):
+    # (host, port) of HOST:PORT, or of PORT alone on `host'
+    name, _, port = address.rpartition(':')
+    return name or host, int(port)
+
+def serve(address):
+    # Serves the board until interrupted, then quits the way the board does
+    global server
+    import asyncio
+    server = BoardServer(board.layers.get(0), board.journal)
+    async def main():
+        listener = await server.start(*address)
+        print('Serving %s on %s' % (SESSION, ', '.join('%s:%s' % sock.getsockname()[:2] for sock in listener.sockets)))
+        async with listener:
+            await asyncio.gather(server.run(), timers())
+    async def timers():
+        # autosaves, journal syncs and saves run as on the board
+        while True:
+            await asyncio.sleep(SERVERTICK/1000)
+            for event in pygame.event.get():
+                if event.type == AUTOSAVE_EVENT:
+                    autosave()
+                elif event.type == JOURNAL_EVENT:
+                    journal_event()
+                elif event.type == WRITER_EVENT and not hasattr(event, 'total'):
+                    if event.error is not None:
+                        print('Error while %s: %s' % (event.label, event.error))
+                        if event.failed is not None:
+                            event.failed()
+                    else:
+                        print(event.result.capitalize())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    if CSPERSISTANCE: save_cursession()
+    writer.join()
+    board.journal.close()
+    if not CSPERSISTANCE: board.journal.remove(board.journal.generation)
+    if pool is not None: pool.shutdown()
+    if STATS:
+        print('Clients: %(clients)s, operations: %(ops)s in %(ticks)s ticks, chunks sent: %(chunks)s (%(bytes)s bytes)' % server.stats)
+        timings.report()
+
+def net_event(event):
+    # A chunk sent by the server replaces ours
+    global link
+    if event.chunk is None:
+        link = None
+        popup('lost the connection to the server, the board is now local')
+        return
+    cs = board.surface.chunksize
+    chunk = event.value
+    if isinstance(chunk, bytes):
+        chunk = pygame.image.fromstring(chunk, (cs,cs), CSIMGFORMAT)
+    elif chunk is not None:
+        chunk = tuple(chunk)
+    board.surface.replace(event.chunk, chunk)
+    damage(chunk_rect(event.chunk, pygame.Rect(0,0,cs,cs)))
+
+# Tile server
+# ***********
+TILEVIEWER = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>BlackBBoard - %(session)s</title>
+<style>html, body { margin: 0; height: 100%%; overflow: hidden; background: #fff; } img { position: absolute; user-select: none; }</style>
+</head><body><script>
+// x, y: board position at the center of the window, zoom: 0 for 1:1, -n for 1:2**n
+var size = %(size)s, levels = %(levels)s, bounds = %(bounds)s, tiles = {};
+var x = bounds[0]+bounds[2]/2, y = bounds[1]+bounds[3]/2, zoom = 0;
+while (zoom > -levels && (bounds[2] > innerWidth*Math.pow(2, -zoom) || bounds[3] > innerHeight*Math.pow(2, -zoom))) zoom--;
+function draw() {
+  var scale = Math.pow(2, zoom), left = x*scale-innerWidth/2, top = y*scale-innerHeight/2, seen = {};
+  for (var tx = Math.floor(left/size); tx*size < left+innerWidth; tx++)
+    for (var ty = Math.floor(top/size); ty*size < top+innerHeight; ty++) {
+      var key = zoom+'/'+tx+'/'+ty, img = tiles[key];
+      if (!img) {
+        img = tiles[key] = new Image();
+        img.onerror = function() { this.style.display = 'none'; };
+        img.draggable = false;
+        img.src = key+'.png';
+        document.body.appendChild(img);
+      }
+      img.style.left = (tx*size-left)+'px';
+      img.style.top = (ty*size-top)+'px';
+      seen[key] = true;
+    }
+  for (var key in tiles)
+    if (!seen[key]) { document.body.removeChild(tiles[key]); delete tiles[key]; }
+}
+var drag = null;
+onmousedown = function(e) { drag = [e.clientX, e.clientY]; e.preventDefault(); };
+onmouseup = function() { drag = null; };
+onmousemove = function(e) {
+  if (!drag) return;
+  x -= (e.clientX-drag[0])/Math.pow(2, zoom);
+  y -= (e.clientY-drag[1])/Math.pow(2, zoom);
+  drag = [e.clientX, e.clientY];
+  draw();
+};
+onwheel = function(e) { zoom = Math.min(0, Math.max(-levels, zoom-Math.sign(e.deltaY))); draw(); };
+onresize = draw;
+draw();
+</script></body></html>
+'''
+
+def tile_viewer(tiles):
+    return TILEVIEWER % {'session': SESSION, 'size': tiles.store.chunksize, 'levels': MIPLEVELS, 'bounds': list(tiles.bounds())}
+
+def tile_server(address, tiles):
+    import http.server
+    server = http.server.ThreadingHTTPServer(address, type('TileHandler', (TileHandler, http.server.BaseHTTPRequestHandler), {}))
+    server.daemon_threads = True
+    server.tiles = tiles
+    return server
+
+def serve_tiles(address):
+    # Serves the tiles of the saved session until interrupted
+    tiles = TileServer(os.path.join(BASEDIR, SESSION))
+    try:
+        tiles.refresh()
+    except FileNotFoundError:
+        print('No saved session to serve for %s' % SESSION)
+        sys.exit(1)
+    server = tile_server(address, tiles)
+    print('Serving the tiles of %s on http://%s:%s/' % (SESSION, *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    if STATS:
+        print('Requests: %(requests)s, tiles encoded: %(misses)s, from the cache: %(hits)s, unchanged: %(unchanged)s' % tiles.stats)
+
+# Idle mode
+# *********
+def busy():
+    # Whether the next frame has to run at full frame rate
+    return isdown or full_redraw or bool(dirty) or bool(overlay_rect)
+
+def wait_event():
+    # Sleeps until an event arrives, accounting for the frames it skips
+    wall, cpu = time.perf_counter(), time.process_time()
+    event = pygame.event.wait(IDLETIMEOUT)
+    wall = time.perf_counter() - wall
+    idle_stats['waits'] += 1
+    idle_stats['wall'] += wall
+    idle_stats['cpu'] += time.process_time() - cpu
+    idle_stats['skipped'] += int(wall*FPS)
+    return event
+
+@timings.timed('prefetch')
+def prefetch():
+    # Decodes PREFETCH of the stored chunks within a window of the view,
+    # nearest first, while the board would otherwise sleep, so that moving
+    # around seldom waits on them; stops once the chunk cache is full, as
+    # they would only push each other out
+    # Returns whether it decoded some
+    layers = board.layers
+    stored = layers.stored
+    if not stored or overview or any(surface.chunks.limit is not None and len(surface.chunks.resident) >= surface.chunks.limit for surface in layers.shown()):
+        return False
+    cs = layers.chunksize
+    w, h = SCREENSIZE
+    x, y = sub_tuples(screen_rect.center, board.offset)
+    positions = [pos for pos in layers.visible((3*w, 3*h), add_tuples(board.offset, (w, h))) if pos in stored]
+    positions.sort(key=lambda pos: abs(-pos[0]*cs+cs//2-x) + abs(-pos[1]*cs+cs//2-y))
+    layers.load(positions[:PREFETCH])
+    return bool(positions)
+
+def startup_step(name):
+    # Marks the end of a startup step, reported with the first frame
+    startup.append((name, time.perf_counter() - start_time))
+
+def startup_report():
+    steps = ', '.join('%s %.3fs' % (name, t-u) for (name, t), (_, u) in zip(startup, [(None, 0.)] + startup))
+    return 'First frame in %.3fs (%s)' % (first_frame, steps)
+
+def print_stats():
+    wall = idle_stats['wall']
+    cpu = 100*idle_stats['cpu']/wall if wall else 0.
+    if first_frame is not None:
+        print(startup_report())
+    print('Frames run: %s' % idle_stats['frames'])
+    print('Frames skipped while idle: %s (%.1fs idle over %s waits)' % (idle_stats['skipped'], wall, idle_stats['waits']))
+    print('Average idle CPU: %.2f%%' % cpu)
+    print('Chunks: %s decoded, %s packed, %s stored' % (len(board.surface.chunks.resident), len(board.surface.chunks.packed), len(board.surface.stored)))
+    print('Chunk cache: %s hits, %s misses, %s evictions, %s drops' % tuple(board.surface.chunks.stats.values()))
+    if not REPLAY:
+        timings.report()
+
+# Event traces
+# ************
+TRACEATTRS = {'pos', 'rel', 'button', 'buttons', 'key', 'mod', 'unicode', 'scancode', 'x', 'y'}
+
+def dump_event(event):
+    return [event.type, {k: v for k, v in event.dict.items() if k in TRACEATTRS}]
+
+def load_event(data):
+    type, attrs = data
+    return pygame.event.Event(type, {k: tuple(v) if isinstance(v, list) else v for k, v in attrs.items()})
+
+def record_events(events):
+    # Timer and writer events are the board's own doing, replays raise them again
+    events = [e for e in events if e.type < USEREVENT]
+    if events:
+        frame = {'t': time.perf_counter()-trace_start, 'mouse': pygame.mouse.get_pos(), 'events': [dump_event(e) for e in events]}
+        trace_out.write(json.dumps(frame) + '\n')
+
+def replay_events():
+    global replay_mouse
+    line = trace_in.readline()
+    if not line:
+        quit()
+    frame = json.loads(line)
+    replay_mouse = tuple(frame['mouse'])
+    events = [load_event(e) for e in frame['events']]
+    replay_stats['events'] += len(events)
+    replay_stats['motions'] += sum(e.type == MOUSEMOTION for e in events)
+    return events
+
+def replay_report():
+    elapsed = time.perf_counter() - trace_start
+    print('Replayed %s events (%s motions) in %s frames, %s stroke batches' % (replay_stats['events'], replay_stats['motions'], idle_stats['frames'], replay_stats['batches']))
+    print('Elapsed: %.3fs, %.0f events/s, %.1f frames/s' % (elapsed, replay_stats['events']/elapsed if elapsed else 0., idle_stats['frames']/elapsed if elapsed else 0.))
+    print('Peak RSS: %.1f MB' % (peak_rss()/1024/1024))
+    timings.report()
+
+def mouse_pos():
+    if REPLAY:
+        return replay_mouse
+    return pygame.mouse.get_pos()
+
+def next_events():
+    if REPLAY:
+        return replay_events() + pygame.event.get(INTERNALEVENTS)
+    events = pygame.event.get()
+    if not events and not busy() and not prefetch():
+        event = wait_event()
+        if event.type != NOEVENT:
+            events = [event] + pygame.event.get()
+    if RECORD:
+        record_events(events)
+    return events
+
+# Pen strokes
+# ***********
+def draw_stroke():
+    # Draws the motion points coalesced since the last call as one polyline
+    if len(stroke) > 1:
+        draw_lines(board.surface, stroke[:], pencolor, penwidth)
+        board.surface.trace(stroke[:], pencolor, penwidth)
+        replay_stats['batches'] += 1
+    del stroke[:-1]
+
 # Tuples
 # ******
 def mul_tuples(t1,t2):
@@ -319,62 +2603,573 @@ def sub_tuples(t1,t2):
     return tuple(a-b for a,b in zip(t1,t2))
 
 def realpos(pos):
-    return sub_tuples(pos, offset)
+    return sub_tuples(pos, board.offset)
 
 def relpos(pos):
-    return add_tuples(pos, offset)
+    return add_tuples(pos, board.offset)
+
+# Damage tracking
+# ***************
+def damage(rect):
+    # Marks a screen rectangle as needing to be recomposited
+    rect = screen_rect.clip(rect)
+    if rect:
+        dirty.append(rect)
+
+def damage_all():
+    global full_redraw
+    full_redraw = True
+
+# Overview
+# ********
+def toggle_overview():
+    global overview, overview_level, overview_center
+    flush()
+    overview = not overview
+    if overview:
+        overview_center, overview_level = fit_overview()
+        popup('overview 1:%s' % 2**overview_level)
+    else:
+        popup('')
+    damage_all()
+
+def fit_overview():
+    # Center and level at which the whole board fits the screen
+    bounds = board.layers.bounds()
+    if not bounds:
+        return sub_tuples(screen_rect.center, board.offset), 1
+    level = 1
+    while level < MIPLEVELS and (bounds.w > screen_rect.w*2**level or bounds.h > screen_rect.h*2**level):
+        level += 1
+    return bounds.center, level
+
+def draw_overview():
+    # Draws the board at 1:2**overview_level from the pyramid, building at
+    # most MIPBUILDS missing tiles per frame; returns whether some are left
+    scale = 2**overview_level
+    cs = board.layers.chunksize
+    view = pygame.Rect(0, 0, screen_rect.w*scale, screen_rect.h*scale)
+    view.center = overview_center
+    positions = [pos for pos in board.layers.positions() if view.colliderect((-pos[0]*cs, -pos[1]*cs, cs, cs))]
+    board.pyramid.update(board.layers)
+    missing = [pos for pos in positions if board.pyramid.tile(pos, overview_level) is None]
+    batch = missing[:MIPBUILDS]
+    board.layers.load(batch)
+    for pos in batch:
+        board.pyramid.build(pos, board.layers.get_chunk(pos))
+    screen.fill(white)
+    for pos in positions:
+        tile = board.pyramid.tile(pos, overview_level)
+        if tile:
+            screen.blit(tile, add_tuples(screen_rect.center, ((-pos[0]*cs-view.centerx)//scale, (-pos[1]*cs-view.centery)//scale)))
+    return len(missing) > len(batch)
+
+def overview_event(event, pos):
+    # The board is not drawn on in the overview: the wheel zooms, and a
+    # click goes back to the board there
+    global overview_level
+    if event.type == KEYDOWN and event.key == ord(KEY_OVERVIEW):
+        toggle_overview()
+    elif event.type == KEYDOWN and event.key == ord(KEY_QUIT):
+        quit()
+    elif event.type == MOUSEBUTTONDOWN and event.button in (4, 5):
+        overview_level = min(max(overview_level + (1 if event.button == 5 else -1), 1), MIPLEVELS)
+        popup('overview 1:%s' % 2**overview_level)
+        damage_all()
+    elif event.type == MOUSEBUTTONDOWN and event.button == 1:
+        point = add_tuples(overview_center, mul_tuple(2**overview_level, sub_tuples(pos, screen_rect.center)))
+        board.offset = sub_tuples(screen_rect.center, point)
+        journal_op('offset', board.offset)
+        toggle_overview()
+
+# Layers
+# ******
+def next_layer():
+    # Draws on the layer above, on a new one past the top unless the top
+    # one is still empty, in which case back on the bottom one
+    if link is not None:
+        popup('the server board has a single layer')
+        return
+    flush()
+    order = board.layers.order
+    i = order.index(board.active)
+    if i+1 < len(order):
+        board.select(order[i+1])
+    elif board.surface.positions():
+        board.select(max(order)+1)
+    else:
+        board.select(order[0])
+    show_layer()
+
+def toggle_layer():
+    # Hides or shows the layer drawn on
+    if link is not None:
+        popup('the server board has a single layer')
+        return
+    flush()
+    arrange(board.layers.toggle(board.active))
+
+def raise_layer():
+    # Moves the layer drawn on one step up
+    if link is not None:
+        popup('the server board has a single layer')
+        return
+    i = board.layers.order.index(board.active)
+    if i+1 == len(board.layers.order):
+        show_layer()
+        return
+    flush()
+    arrange(board.layers.swap(i, i+1))
+
+def stroke_layer():
+    # Draws on a new layer past the top that keeps its strokes, so they
+    # can be erased or restyled one by one
+    if link is not None:
+        popup('the server board has a single layer')
+        return
+    flush()
+    id = max(board.layers.order)+1
+    board.layers.get(id, True)
+    journal_op('layers', board.layers.order, sorted(board.layers.hidden), board.layers.vector())
+    board.select(id)
+    show_layer()
+
+def restyle(pos):
+    # Gives the stroke under `pos' the pen color and width
+    if not board.surface.vector:
+        popup('only strokes of a stroke layer can be restyled')
+        return
+    if not board.surface.hit(pygame.Rect(realpos(pos), (0,0))):
+        popup('no stroke there')
+        return
+    flush()
+    journal_op('restyle', realpos(pos), pencolor, penwidth)
+    for pos, area in board.surface.restyle(realpos(pos), pencolor, penwidth):
+        damage(chunk_rect(pos, area))
+    show_history()
+    popup('restyled')
+
+def arrange(positions):
+    # Journals the order and visibility of the layers, and redraws the
+    # chunks that changed with them
+    journal_op('layers', board.layers.order, sorted(board.layers.hidden), board.layers.vector())
+    cs = board.layers.chunksize
+    for pos in positions:
+        damage(chunk_rect(pos, pygame.Rect(0,0,cs,cs)))
+    show_layer()
+
+def show_layer():
+    order = board.layers.order
+    popup('layer %s/%s%s%s' % (order.index(board.active)+1, len(order), ' (strokes)' if board.surface.vector else '', ' (hidden)' if board.active in board.layers.hidden else ''))
 
 # Save to page
 # ************
-def pre_render():
+@timings.timed('pre_render')
+def pre_render(rects=None):
     global rendered_pos
     rendered_pos = []
-    screen.fill(white)
+    if rects is None:
+        rects = [screen_rect]
     result = []
-    for pos, chunk in surface.retrieve_chunks(screen.get_size(), offset):
-        result.append(str(pos))
-        screen.blit(chunk, sub_tuples(offset,pos))
+    for rect in rects:
+        screen.set_clip(rect)
+        screen.fill(white, rect)
+        for pos, chunk in board.layers.retrieve_chunks(rect.size, sub_tuples(board.offset, rect.topleft)):
+            result.append(str(pos))
+            screen.blit(chunk, sub_tuples(board.offset,pos))
+        screen.blit(board.temp_surf, rect.topleft, rect)
+    screen.set_clip(None)
     rendered_pos.extend(result)
-    screen.blit(temp_surf,(0,0))
     
 def full_render():
     pre_render()
     flush()
+    damage_all()
 
+@timings.timed('render')
 def render():
-    pre_render()
+    global full_redraw, overlay_rect, first_frame
+    rects = dirty[:]
+    del dirty[:]
+    if overlay_rect:
+        rects.append(overlay_rect)
+        overlay_rect = None
+    left = False
+    if overview:
+        if full_redraw or rects:
+            full_redraw = True
+            left = draw_overview()
+    elif full_redraw:
+        pre_render()
+    elif rects:
+        pre_render(rects)
     screen.blit(popup_surface, popup_pos)
     screen.blit(tool_surface, tool_pos)
     screen.blit(color_surface, color_pos)
+    if debug:
+        screen.blit(debug_surface, debug_pos)
+    if profiling:
+        screen.blit(profile_surface, profile_pos)
     if lock.lock in {'m3', KEY_CUT, KEY_COPY, KEY_DELETE, KEY_FILL} and isdown:
         x1, y1 = anchor
-        x2, y2 = pygame.mouse.get_pos()
+        x2, y2 = mouse_pos()
         points = ((x1,y1),(x2,y1),(x2,y2),(x1,y2))
-        pygame.draw.aalines(screen, grey, True, points, 4)
+        overlay_rect = pygame.draw.aalines(screen, grey, True, points, 4).inflate(2,2)
     if lock.lock in {KEY_RESIZE} and isdown:
-        pygame.draw.circle(screen, grey, anchor, (penwidth)>>1)
-    pygame.display.flip()
+        overlay_rect = pygame.draw.circle(screen, grey, anchor, (penwidth)>>1).inflate(2,2)
+    if overlay_rect:
+        rects.append(overlay_rect)
+    if full_redraw:
+        pygame.display.flip()
+        full_redraw = left
+    elif rects:
+        pygame.display.update(rects)
+    if first_frame is None:
+        first_frame = time.perf_counter() - start_time
+        startup_step('first frame')
+        if STATS:
+            print(startup_report())
     
+@timings.timed('save')
 def save():
     global page
     full_render()
-    pygame.image.save(screen, os.path.join(DIR, SESSION, ("%s-%s.%s" % (SESSION, page, FORMAT))))
-    popup('saved page %s' % page)
+    writer.submit('saving page %s' % page, write_page, screen.copy(), os.path.join(DIR, SESSION, ("%s-%s.%s" % (SESSION, page, FORMAT))), page)
     page += 1
 
+@timings.timed('write')
+def write_page(progress, image, path, page):
+    pygame.image.save(image, path)
+    return 'saved page %s' % page
+
+def writer_event(event):
+    if hasattr(event, 'total'):
+        popup('%s... %s/%s' % (event.label, event.done, event.total))
+    elif event.error is not None:
+        print('Error while %s: %s' % (event.label, event.error))
+        popup('error while %s: %s' % (event.label, event.error))
+        if event.failed is not None:
+            event.failed()
+    else:
+        popup(event.result)
+
+# Export
+# ******
+def export_board(path, rect=None, scale=1, progress=None, layers=None):
+    # Renders `rect' of the board (all of it by default), given in board
+    # coordinates, into `path' at 1:`scale', from `layers' if given rather
+    # than the board; bands of chunks are encoded as soon as they are
+    # drawn, so the image is never whole in memory
+    if layers is None:
+        layers = board.layers
+    rect = layers.bounds() if rect is None else pygame.Rect(rect)
+    if not rect:
+        return 'nothing to export'
+    rect.size = (-(-rect.w//scale)*scale, -(-rect.h//scale)*scale)
+    size = (rect.w//scale, rect.h//scale)
+    kind = os.path.splitext(path)[1].lower()
+    if kind not in EXPORTERS:
+        raise ValueError('cannot export to %s files, only to %s' % (kind, ', '.join(sorted(EXPORTERS))))
+    if progress is None:
+        progress = lambda done, total: None
+    with open(path, 'wb') as file:
+        EXPORTERS[kind](file, layers, rect, scale, progress)
+    return 'exported %sx%s board to %s' % (*size, path)
+
+def render_rect(layers, rect, scale):
+    # RGB pixels of `rect' of `layers' on white, at 1:`scale'
+    image = pygame.Surface(rect.size)
+    image.fill(white)
+    areas = list(layers.areas(rect))
+    layers.load([pos for pos, area in areas])
+    for pos, area in areas:
+        chunk = layers.get_chunk(pos)
+        if chunk:
+            image.blit(chunk, (-pos[0]*layers.chunksize-rect.left, -pos[1]*layers.chunksize-rect.top))
+    if scale > 1:
+        image = pygame.transform.smoothscale(image, (rect.w//scale, rect.h//scale))
+    return pygame.image.tostring(image, 'RGB')
+
+def export_bands(layers, rect, scale, progress):
+    # Yields the rows of `rect' one band of chunks at a time
+    height = layers.chunksize*scale
+    total = -(-rect.h//height)
+    for i, top in enumerate(range(rect.top, rect.bottom, height)):
+        progress(i, total)
+        yield render_rect(layers, pygame.Rect(rect.left, top, rect.w, min(height, rect.bottom-top)), scale)
+
+def png_chunk(file, kind, data):
+    file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+def export_png(file, layers, rect, scale, progress):
+    width, height = rect.w//scale, rect.h//scale
+    file.write(b'\x89PNG\r\n\x1a\n')
+    png_chunk(file, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+    compressor = zlib.compressobj(EXPORTLEVEL)
+    for band in export_bands(layers, rect, scale, progress):
+        # each row starts with its filter type, none
+        data = compressor.compress(b''.join(b'\0' + band[i:i+3*width] for i in range(0, len(band), 3*width)))
+        if data:
+            png_chunk(file, b'IDAT', data)
+    png_chunk(file, b'IDAT', compressor.flush())
+    png_chunk(file, b'IEND', b'')
+
+def export_tiff(file, layers, rect, scale, progress):
+    # Uncompressed strips, one per band, whose layout is known beforehand
+    width, height = rect.w//scale, rect.h//scale
+    rows = layers.chunksize
+    strips = -(-height//rows)
+    counts = [3*width*min(rows, height-i*rows) for i in range(strips)]
+    entries = 10
+    extra = 8 + 2 + 12*entries + 4
+    start = extra + 6 + 8*strips
+    if start + sum(counts) >= 2**32:
+        raise ValueError('%sx%s is too large for a TIFF file' % (width, height))
+    offsets = list(itertools.accumulate([start] + counts[:-1]))
+    file.write(b'II*\0' + struct.pack('<I', 8) + struct.pack('<H', entries))
+    for tag, kind, count, value in [
+        (256, 4, 1, width), (257, 4, 1, height),
+        (258, 3, 3, extra), (259, 3, 1, 1), (262, 3, 1, 2),
+        (273, 4, strips, extra+6 if strips > 1 else offsets[0]),
+        (277, 3, 1, 3), (278, 4, 1, rows),
+        (279, 4, strips, extra+6+4*strips if strips > 1 else counts[0]),
+        (284, 3, 1, 1)
+    ]:
+        file.write(struct.pack('<HHII', tag, kind, count, value))
+    file.write(struct.pack('<I', 0) + struct.pack('<3H', 8, 8, 8))
+    file.write(struct.pack('<%sI' % strips, *offsets) + struct.pack('<%sI' % strips, *counts))
+    for band in export_bands(layers, rect, scale, progress):
+        file.write(band)
+
+def export_pdf(file, layers, rect, scale, progress):
+    # One page per window-sized tile of the export, one pixel per point
+    pw, ph = SCREENSIZE[0]*scale, SCREENSIZE[1]*scale
+    tiles = [pygame.Rect(x, y, min(pw, rect.right-x), min(ph, rect.bottom-y)) for y in range(rect.top, rect.bottom, ph) for x in range(rect.left, rect.right, pw)]
+    offsets = []
+    def write_object(data, stream=None):
+        offsets.append(file.tell())
+        file.write(b'%d 0 obj\n' % len(offsets) + data)
+        if stream is not None:
+            file.write(b'\nstream\n' + stream + b'\nendstream')
+        file.write(b'\nendobj\n')
+    file.write(b'%PDF-1.4\n')
+    write_object(b'<< /Type /Catalog /Pages 2 0 R >>')
+    write_object(b'<< /Type /Pages /Count %d /Kids [%s] >>' % (len(tiles), b' '.join(b'%d 0 R' % (3+3*i) for i in range(len(tiles)))))
+    for i, tile in enumerate(tiles):
+        progress(i, len(tiles))
+        width, height = tile.w//scale, tile.h//scale
+        image = zlib.compress(render_rect(layers, tile, scale), EXPORTLEVEL)
+        content = b'q %d 0 0 %d 0 0 cm /Im0 Do Q' % (width, height)
+        write_object(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>' % (width, height, 5+3*i, 4+3*i))
+        write_object(b'<< /Length %d >>' % len(content), content)
+        write_object(b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /Length %d >>' % (width, height, len(image)), image)
+    xref = file.tell()
+    file.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets)+1))
+    file.write(b''.join(b'%010d 00000 n \n' % offset for offset in offsets))
+    file.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(offsets)+1, xref))
+
+EXPORTERS = {'.png': export_png, '.tif': export_tiff, '.tiff': export_tiff, '.pdf': export_pdf}
+
+def export():
+    # The whole board, saved first then exported from the session on the
+    # writer thread, after the save and apart from the board drawn on
+    if link is not None:
+        popup('the session is kept by the server')
+        return
+    save_cursession()
+    writer.submit('exporting board', export_session, board.path, os.path.join(DIR, SESSION, '%s-board.png' % SESSION))
+
+def export_session(progress, session, path):
+    return export_board(path, progress=progress, layers=session_layers(session))
+
+def session_layers(path):
+    # Layers of the session saved in `path', with stores of their own
+    session = Board(path, (0,0))
+    offset, surface, dirty = read_cursession(session.store)
+    session.load(offset, surface)
+    session.load_layers()
+    return session.layers
+
+# Batch
+# *****
+def open_session(path):
+    # Makes the session saved in `path' the board
+    global board
+    board = Board(path)
+    offset, surface, dirty = read_cursession(board.store)
+    if not surface[2].exists() and not surface[1]:
+        raise FileNotFoundError('no saved session in %s' % path)
+    board.load(offset, surface)
+    board.load_layers()
+
+def batch_convert(path):
+    # Re-encodes every chunk into FORMAT, dropping superseded and empty
+    # ones; sessions saved before the pack format are migrated
+    open_session(path)
+    if not board.store.exists():
+        raw = {pos: pygame.image.tostring(chunk, CSIMGFORMAT) for pos, chunk in board.surface.chunks.items()}
+        board.store.write(board.surface.chunksize, board.offset, {pos: (data, 'string') for pos, data in raw.items()})
+    return '\n'.join(compact_cursession(FORMAT))
+
+def batch_pages(path):
+    # The board cut into window-sized pages, leaving out blank ones
+    if FORMAT == 'string':
+        raise ValueError('pages cannot be saved as string')
+    open_session(path)
+    name = os.path.basename(board.store.path)
+    bounds = board.layers.bounds()
+    os.makedirs(os.path.join(DIR, name), exist_ok=True)
+    pages = [pygame.Rect(x, y, *SCREENSIZE) for y in range(bounds.top, bounds.bottom, SCREENSIZE[1]) for x in range(bounds.left, bounds.right, SCREENSIZE[0])]
+    pages = [rect for rect in pages if any(board.layers.exists(pos) for pos, area in board.layers.areas(rect))]
+    for i, rect in enumerate(pages):
+        page = pygame.image.fromstring(render_rect(board.layers, rect, 1), rect.size, 'RGB')
+        pygame.image.save(page, os.path.join(DIR, name, '%s-board-%s.%s' % (name, i+1, FORMAT)))
+    return 'Saved %s pages of %s' % (len(pages), name)
+
+def batch_export(path):
+    open_session(path)
+    name = os.path.basename(board.store.path)
+    os.makedirs(os.path.join(DIR, name), exist_ok=True)
+    return '%s: %s' % (name, export_board(os.path.join(DIR, name, '%s-board.png' % name), None, args.export_scale))
+
+def batch_verify(path):
+    # Decodes every chunk and overview tile, and reads the journal through
+    open_session(path)
+    name = os.path.basename(board.store.path)
+    if not board.store.exists():
+        return '%s: ok, %s chunks saved before the pack format' % (name, len(board.surface.chunks))
+    cs = board.store.chunksize
+    problems = []
+    stores = session_stores()
+    for id, store in stores.items():
+        layer = 'layer %s ' % id if id else ''
+        if store.chunksize != cs:
+            problems.append('%schunk size %s instead of %s' % (layer, store.chunksize, cs))
+            continue
+        pack = os.path.join(store.path, store.pack)
+        end = os.path.getsize(pack) if os.path.isfile(pack) else 0
+        for pos, (start, length, format) in sorted(store.index.items(), key=lambda entry: entry[1][0]):
+            try:
+                if start+length > end:
+                    raise ValueError('past the end of the pack')
+                data, format = store.read(pos)
+                size = len(data) if format == CSUNIFORM else len(decode_chunk(data, format))
+                if size != (4 if format == CSUNIFORM else 4*cs*cs):
+                    raise ValueError('%s bytes of pixels' % size)
+            except Exception as e:
+                problems.append('%schunk %s: %s' % (layer, pos, e))
+    tiles = 0
+    if board.mipstore.exists():
+        board.mipstore.open()
+        tilesize = 4*sum(size*size for size in Pyramid(cs, board.mipstore).sizes[MIPPERSIST:])
+        for pos in board.mipstore.index:
+            try:
+                if len(zlib.decompress(board.mipstore.read(pos)[0])) != tilesize:
+                    raise ValueError('wrong size')
+            except Exception as e:
+                problems.append('overview tile %s: %s' % (pos, e))
+        tiles = len(board.mipstore.index)
+    journal = Journal(board.store.path, board.store.journal)
+    lines = 0
+    for generation in journal.generations():
+        with open(journal.filename(generation)) as file:
+            lines += sum(1 for line in file)
+    records = sum(1 for record in journal.records())
+    if problems:
+        raise ValueError('%s problems, %s' % (len(problems), ', '.join(problems[:BATCHPROBLEMS])))
+    torn = ' (torn after %s, the rest is lost)' % records if records < lines else ''
+    layers = ' in %s layers' % len(stores) if len(stores) > 1 else ''
+    return '%s: ok, %s chunks%s, %s overview tiles, %s journaled operations%s' % (name, sum(len(store.index) for store in stores.values()), layers, tiles, records, torn)
+
+def batch_stats(path):
+    open_session(path)
+    name = os.path.basename(board.store.path)
+    cs = board.surface.chunksize
+    if board.store.exists():
+        stores = [store for store in session_stores().values() if store.chunksize == cs]
+        entries = (store.read(pos) for store in stores for pos in store.index)
+    else:
+        stores = []
+        entries = ((pygame.image.tostring(chunk, CSIMGFORMAT), 'string') for chunk in board.surface.chunks.values())
+    chunks = uniform = ink = 0
+    for data, format in entries:
+        chunks += 1
+        if format == CSUNIFORM:
+            uniform += 1
+            ink += cs*cs if data[3] else 0
+        else:
+            data = decode_chunk(data, format)
+            ink += len(data)//4 - data[3::4].count(0)
+    # over every layer, hidden ones included
+    bounds = pygame.Rect(0,0,0,0)
+    for surface in board.layers.surfaces.values():
+        if surface.positions():
+            bounds = bounds.union(surface.bounds()) if bounds else surface.bounds()
+    size = sum(os.path.getsize(os.path.join(board.store.path, file)) for file in os.listdir(board.store.path))
+    live = sum(length for store in stores for start, length, format in store.index.values())
+    layers = ' in %s layers' % len(stores) if len(stores) > 1 else ''
+    return '%s: %s chunks (%s uniform) of %sx%s%s, board %sx%s at %s, %s inked pixels (%.2f%%), %s bytes on disk, %s of them live chunks' % (
+        name, chunks, uniform, cs, cs, layers, bounds.w, bounds.h, bounds.topleft, ink, 100*ink/(bounds.w*bounds.h) if bounds else 0., size, live)
+
+BATCHACTIONS = {
+    'convert': batch_convert,
+    'pages': batch_pages,
+    'export': batch_export,
+    'verify': batch_verify,
+    'stats': batch_stats,
+}
+
+def batch_job(action, path):
+    # Returns whether `action' went well, and what to print
+    try:
+        return True, BATCHACTIONS[action](path)
+    except Exception as e:
+        return False, '%s: %s' % (os.path.basename(os.path.normpath(path)), e)
+
+def batch_worker():
+    # Each session runs in one process, without a chunk pool of its own
+    global WORKERS, pool, writer
+    WORKERS, pool = 1, None
+    writer = Writer()
+
+def run_batch(action, sessions):
+    # Returns the exit code, 1 if any session failed; sessions are
+    # directories, or names of sessions of BASEDIR
+    paths = [os.path.normpath(session if os.path.isdir(session) else os.path.join(BASEDIR, session)) for session in sessions]
+    import concurrent.futures
+    failed = 0
+    if WORKERS > 1 and len(paths) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(min(WORKERS, len(paths)), mp_context=pool_context(), initializer=batch_worker)
+        results = executor.map(batch_job, itertools.repeat(action), paths)
+    else:
+        executor = None
+        results = map(batch_job, itertools.repeat(action), paths)
+    for ok, message in results:
+        print(message)
+        failed += not ok
+    if executor is not None:
+        executor.shutdown()
+    return 1 if failed else 0
+
 # Better drawing functions
 # ************************
 def drawing(commit=True):
     def decorator(function):
         @functools.wraps(function)
         def wrapper(surface, *args, **kwargs):
-            global need_flush
-            n = function(temp_surf, *args, **kwargs)
+            n = function(board.temp_surf, *args, **kwargs)
+            if n:
+                journal_op(function.__name__, *args)
+                damage(n)
+                if board.flush_rect:
+                    board.flush_rect.union_ip(n)
+                else:
+                    board.flush_rect.update(n)
             if commit and n:
-                need_flush = True
+                board.need_flush = True
                 flush()
             else:
-                need_flush |= n
+                board.need_flush |= bool(n)
         return wrapper
     return decorator
 
@@ -387,116 +3182,493 @@ def make_rect(pos1,pos2):
     h = max(y1,y2) - top
     return pygame.Rect(left, top, w, h)
 @drawing(False)
-def draw_line(surface, pos1, pos2, color, width):
-    pos1=pos1
-    pos2=pos2
-    pygame.gfxdraw.filled_circle(surface,*pos1,width//2,color)
-    pygame.gfxdraw.filled_circle(surface,*pos2,width//2,color)
-    pygame.draw.line(surface,color,pos1,pos2,width+1)
-    return True
+def draw_lines(surface, points, color, width):
+    # Draws a whole polyline at once, with a single round join per point
+    for point in points:
+        pygame.gfxdraw.filled_circle(surface,*point,width//2,color)
+    rect = pygame.draw.lines(surface,color,False,points,width+1)
+    return rect.inflate(width+2,width+2)
 def delete(surface, pos1, pos2):
     erase(surface, pos1, pos2)
     popup('deleted')
     return True
-@drawing()
 def erase(surface, pos1, pos2):
-    pygame.draw.rect(surface, white, make_rect(pos1,pos2))
-    return True
+    # Clears the chunks themselves, as drawing white through temp_surf
+    # would leave opaque chunks behind; on a stroke layer, a click removes
+    # the stroke under it
+    flush()
+    rect = screen_rect.clip(make_rect(pos1,pos2))
+    if surface.vector and not rect and screen_rect.collidepoint(pos1):
+        rect = pygame.Rect(pos1, (0,0))
+    if rect or surface.vector and screen_rect.collidepoint(rect.topleft):
+        journal_op('erase', rect.move(mul_tuple(-1, board.offset)))
+        for pos, area in surface.erase(rect.move(mul_tuple(-1, board.offset))):
+            damage(chunk_rect(pos, area))
+    show_history()
 def copy(surface, pos1, pos2):
-    global buffer
-    full_render()
-    buffer = screen.subsurface(make_rect(pos1,pos2)).copy()
-    buffer.set_colorkey(white)
+    # The clip shares the chunks with the board, no pixel is copied yet
+    flush()
+    rect = make_rect(pos1,pos2).move(mul_tuple(-1, board.offset))
+    journal_op('copy', rect)
+    board.buffer = surface.copy(rect)
     popup('copied')
-@drawing()
 def cut(surface, pos1, pos2):
     copy(surface, pos1, pos2)
     erase(surface, pos1, pos2)
     popup('cuted')
-    return True
-@drawing()
 def paste(surface, pos1):
-    global buffer
-    if buffer == None:
+    if board.buffer == None:
+        return False
+    if surface.vector:
+        popup('nothing but strokes goes on a stroke layer')
         return False
-    surface.blit(buffer, pos1)
+    flush()
+    journal_op('paste', realpos(pos1))
+    for pos, area in surface.paste(board.buffer, realpos(pos1)):
+        damage(chunk_rect(pos, area))
+    show_history()
     popup('pasted')
     return True
+def bucket(surface, pos1, color):
+    # Fills the region around `pos1' looking like it, on the board rather
+    # than on temp_surf, as it may reach outside of the window
+    if surface.vector:
+        popup('nothing but strokes goes on a stroke layer')
+        return
+    flush()
+    changed = surface.flood(realpos(pos1), color, FILLLIMIT)
+    if changed is None:
+        popup('not filled, the region is over %s megapixels' % args.fill_limit)
+        return
+    journal_op('flood', realpos(pos1), color)
+    for pos, area in changed:
+        damage(chunk_rect(pos, area))
+    show_history()
+    popup('filled')
 @drawing()
 def fill(surface, pos1, pos2, color):
-    pygame.draw.rect(surface, color, make_rect(pos1,pos2))
+    if board.surface.vector:
+        popup('nothing but strokes goes on a stroke layer')
+        return None
+    rect = pygame.draw.rect(surface, color, make_rect(pos1,pos2))
     popup('filled')
-    return True
+    return rect
 def popup(*args, sep=' '):
     string = sep.join(str(e) for e in args)
     text = font.render(string, True, black)
     popup_surface.fill(white)
     pygame.draw.rect(popup_surface, grey, pygame.Rect(0,0,popup_surface.get_width(),popup_surface.get_height()),3)
     popup_surface.blit(text, (2,2))
+    damage(popup_surface.get_rect(topleft=popup_pos))
 def chtool(tool):
     text = font.render('Tool: %s' % tool, True, black)
     tool_surface.fill(white)
     pygame.draw.rect(tool_surface, grey, pygame.Rect(0,0,tool_surface.get_width(),tool_surface.get_height()),3)
     tool_surface.blit(text, (2,2))
+    damage(tool_surface.get_rect(topleft=tool_pos))
+@timings.timed('flush')
 def flush():
-    global need_flush
-    if need_flush == False:
+    if board.need_flush == False:
         return
-    surface.blit(temp_surf, mul_tuple(1,offset))
-    temp_surf.fill(transparent)
-    need_flush = False
+    journal_op('flush', board.offset, board.flush_rect)
+    for pos, area in board.surface.blit(board.temp_surf, mul_tuple(1,board.offset), board.flush_rect):
+        damage(chunk_rect(pos, area))
+    board.temp_surf.fill(transparent, board.flush_rect)
+    board.flush_rect.update(0,0,0,0)
+    board.need_flush = False
+    show_history()
+
+##################
+### BENCHMARKS ###
+##################
+
+BENCHCHUNKS = 256
+BENCHSEED = 0
+
+def bench_chunks(size, count):
+    # Chunks with a few random strokes, looking like a used board
+    rng = random.Random(BENCHSEED)
+    chunks = []
+    for i in range(count):
+        chunk = pygame.Surface((size,size), SRCALPHA)
+        chunk.fill(transparent)
+        for j in range(rng.randrange(1, 8)):
+            points = [(rng.randrange(size), rng.randrange(size)) for k in range(rng.randrange(2, 12))]
+            pygame.draw.lines(chunk, rng.choice(colors), False, points, rng.randrange(1, 9))
+        chunks.append(chunk)
+    return chunks
+
+def bench_workers(maxworkers):
+    counts = [1]
+    while counts[-1]*2 <= maxworkers:
+        counts.append(counts[-1]*2)
+    if counts[-1] != maxworkers:
+        counts.append(maxworkers)
+    return counts
+
+def bench_codec():
+    # Chunks per second encoded and decoded through the chunk pool,
+    # for each format and worker count
+    global WORKERS, pool
+    size = args.chunk_size
+    raw = [pygame.image.tostring(chunk, CSIMGFORMAT) for chunk in bench_chunks(size, BENCHCHUNKS)]
+    maxworkers = WORKERS
+    print('%s chunks of %sx%s' % (len(raw), size, size))
+    print('%-8s %8s %16s %16s %12s' % ('format', 'workers', 'encode chunks/s', 'decode chunks/s', 'bytes/chunk'))
+    for format in sorted(FORMATS):
+        for workers in bench_workers(maxworkers):
+            WORKERS, pool = workers, None
+            if workers > 1:
+                # the workers are started before timing
+                list(get_pool().map(abs, range(workers)))
+            start = time.perf_counter()
+            try:
+                encoded = list(map_chunks(encode_chunk, raw, itertools.repeat(format), itertools.repeat(size)))
+            except Exception as e:
+                print('%-8s %8s %s' % (format, workers, e))
+                break
+            encode = time.perf_counter() - start
+            start = time.perf_counter()
+            load_chunks(encoded, size, [format]*len(encoded), parallel=True)
+            decode = time.perf_counter() - start
+            if pool is not None: pool.shutdown()
+            print('%-8s %8s %16.0f %16.0f %12.0f%s' % (format, workers, len(raw)/encode, len(raw)/decode, sum(map(len, encoded))/len(encoded), '' if format in CSPOOLFORMATS or workers == 1 else '  (not pooled by sessions)'))
+    WORKERS, pool = maxworkers, None
+
+def bench_flush():
+    # Time to commit a square stroke of growing size, flushing only the
+    # stroke's bounding box or the whole window
+    rounds = 50
+    temp = pygame.Surface(SCREENSIZE, SRCALPHA)
+    temp.fill(transparent)
+    print('window %sx%s, chunks of %sx%s, %s flushes per size' % (*SCREENSIZE, args.chunk_size, args.chunk_size, rounds))
+    print('%8s %14s %14s %8s' % ('stroke', 'box ms/flush', 'full ms/flush', 'speedup'))
+    sizes = [1, 4, 16, 64, 256, min(SCREENSIZE)]
+    for size in sizes:
+        times = []
+        for full in (False, True):
+            board = Surface(args.chunk_size)
+            rng = random.Random(BENCHSEED)
+            start = time.perf_counter()
+            for i in range(rounds):
+                pos = (rng.randrange(SCREENSIZE[0]-size+1), rng.randrange(SCREENSIZE[1]-size+1))
+                rect = pygame.draw.rect(temp, rng.choice(colors), pygame.Rect(pos, (size,size)))
+                board.blit(temp, (0,0), None if full else rect)
+                temp.fill(transparent, None if full else rect)
+            times.append((time.perf_counter()-start)/rounds)
+        print('%8s %14.3f %14.3f %7.1fx' % ('%spx' % size, 1000*times[0], 1000*times[1], times[1]/times[0]))
+
+def bench_backends():
+    # Chunks per second through each chunk operation, for each backend
+    global backend
+    size = args.chunk_size
+    used = bench_chunks(size, BENCHCHUNKS)
+    empty = [pygame.Surface((size,size), SRCALPHA) for chunk in used]
+    uniform = [pygame.Surface((size,size), SRCALPHA) for chunk in used]
+    for chunk, color in zip(empty + uniform, itertools.cycle([transparent] + colors)):
+        chunk.fill(color)
+    rng = random.Random(BENCHSEED)
+    areas = [pygame.Rect(rng.randrange(size//2), rng.randrange(size//2), rng.randrange(1, size//2), rng.randrange(1, size//2)) for chunk in used]
+    copies = [chunk.copy() for chunk in used]
+    backends = [name for name in CHUNKBACKENDS if name != 'numpy' or numpy is not None]
+    operations = [
+        ('color, used', lambda ops: [ops.color(chunk) for chunk in used]),
+        ('color, empty', lambda ops: [ops.color(chunk) for chunk in empty]),
+        ('color, uniform', lambda ops: [ops.color(chunk) for chunk in uniform]),
+        ('erase area', lambda ops: [ops.fill(chunk, area, transparent) for chunk, area in zip(copies, areas)]),
+    ]
+    print('%s chunks of %sx%s' % (len(used), size, size))
+    print('%-16s' % 'chunks/s' + ''.join('%12s' % name for name in backends) + ('%10s' % 'speedup' if len(backends) > 1 else ''))
+    for label, operation in operations:
+        rates = []
+        for name in backends:
+            backend = CHUNKBACKENDS[name]()
+            start = time.perf_counter()
+            operation(backend)
+            rates.append(len(used)/(time.perf_counter()-start))
+        print('%-16s' % label + ''.join('%12.0f' % rate for rate in rates) + ('%9.1fx' % (rates[-1]/rates[0]) if len(rates) > 1 else ''))
+    backend = CHUNKBACKENDS[CHUNKBACKEND]()
+
+BENCHCLIENTS = [1, 4, 16]
+BENCHSECONDS = 2
+
+def bench_serve():
+    # Operations applied and chunks sent per second by a board server on
+    # localhost, for a growing number of simulated boards drawing strokes at
+    # FPS in the same view; latency is from sending a stroke to being sent
+    # the chunk it ends in
+    import asyncio
+    pygame.init()
+    size = args.chunk_size
+    view = (SCREENSIZE[0]//2, SCREENSIZE[1]//2)
+    print('view %sx%s, chunks of %sx%s, %ss per run' % (*view, size, size, BENCHSECONDS))
+    print('%8s %10s %10s %10s %12s %12s' % ('clients', 'ops/s', 'chunks/s', 'KB/s', 'p50 ms', 'p95 ms'))
+    async def board(i, port, end, latencies):
+        reader, writer = await asyncio.open_connection('localhost', port, limit=SERVERLINE)
+        await reader.readline()
+        writer.write(BoardServer.encode('view', (0,0), view))
+        sent = collections.defaultdict(list)
+        async def read():
+            async for line in reader:
+                op, pos, value = json.loads(line)
+                now = time.perf_counter()
+                latencies.extend(now-t for t in sent.pop(tuple(pos), ()))
+        reading = asyncio.ensure_future(read())
+        rng = random.Random(BENCHSEED+i)
+        point = (rng.randrange(view[0]), rng.randrange(view[1]))
+        stroke = pygame.Rect(point, (0,0))
+        n = 0
+        while time.perf_counter() < end:
+            points = [point]
+            for j in range(3):
+                point = (min(max(point[0]+rng.randrange(-20, 21), 0), view[0]-1), min(max(point[1]+rng.randrange(-20, 21), 0), view[1]-1))
+                points.append(point)
+            writer.write(BoardServer.encode('draw_lines', points, colors[i % len(colors)], 4))
+            stroke.unionall_ip([pygame.Rect(p, (1,1)).inflate(6,6) for p in points])
+            sent[(-(point[0]//size), -(point[1]//size))].append(time.perf_counter())
+            n += 1
+            if n % 20 == 0:
+                # the pen is lifted
+                writer.write(BoardServer.encode('flush', (0,0), stroke))
+                stroke = pygame.Rect(point, (0,0))
+            await writer.drain()
+            await asyncio.sleep(1/FPS)
+        reading.cancel()
+        writer.close()
+    async def run(count):
+        with tempfile.TemporaryDirectory() as path:
+            server = BoardServer(Surface(size), Journal(path, 0))
+            listener = await server.start('localhost', 0)
+            ticking = asyncio.ensure_future(server.run())
+            latencies = []
+            start = time.perf_counter()
+            await asyncio.gather(*(board(i, listener.sockets[0].getsockname()[1], start+BENCHSECONDS, latencies) for i in range(count)))
+            elapsed = time.perf_counter() - start
+            ticking.cancel()
+            listener.close()
+            server.journal.close()
+        latencies.sort()
+        p50, p95 = (1000*latencies[min(len(latencies)-1, len(latencies)*p//100)] if latencies else 0. for p in (50, 95))
+        print('%8s %10.0f %10.0f %10.0f %12.1f %12.1f' % (count, server.stats['ops']/elapsed, server.stats['chunks']/elapsed, server.stats['bytes']/elapsed/1024, p50, p95))
+    for count in BENCHCLIENTS:
+        asyncio.run(run(count))
+
+BENCHVIEWERS = 16
+BENCHREQUESTS = 200
+
+def bench_tiles():
+    # Requests per second and latency of the tile server for BENCHVIEWERS
+    # viewers on localhost, over a session of BENCHCHUNKS chunks: every tile
+    # once with a cold cache, BENCHREQUESTS random ones each with a warm
+    # cache, and as many revalidated with their ETag
+    import http.client
+    size = args.chunk_size
+    side = int(math.sqrt(BENCHCHUNKS))
+    with tempfile.TemporaryDirectory() as path:
+        store = SessionStore(path)
+        mips = SessionStore(path, MIPINDEX, MIPPACK, MIPPACKMASK)
+        pyramid = Pyramid(size, mips)
+        raw = {(-(i % side), -(i//side)): pygame.image.tostring(chunk, CSIMGFORMAT) for i, chunk in enumerate(bench_chunks(size, side*side))}
+        store.write(size, (0,0), {pos: (encode_chunk(data, 'png', size), 'png') for pos, data in raw.items()})
+        mips.write(size, (0,0), {pos: (zlib.compress(pyramid.raw(pos, data), CHUNKLEVEL), MIPFORMAT) for pos, data in raw.items()})
+        tiles = TileServer(path)
+        server = tile_server(('localhost', 0), tiles)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls = ['/%s/%s/%s.png' % (-level, x, y) for level in range(MIPLEVELS+1) for x in range(-(-side//2**level)) for y in range(-(-side//2**level))]
+        etags = {}
+        def view(requests, revalidate, latencies):
+            connection = http.client.HTTPConnection(*server.server_address[:2])
+            for url in requests:
+                start = time.perf_counter()
+                connection.request('GET', url, headers={'If-None-Match': etags[url]} if revalidate else {})
+                response = connection.getresponse()
+                response.read()
+                latencies.append(time.perf_counter()-start)
+                etags[url] = response.getheader('ETag')
+            connection.close()
+        print('%s chunks of %sx%s, %s tiles over %s levels, %s viewers' % (side*side, size, size, len(urls), MIPLEVELS+1, BENCHVIEWERS))
+        print('%-12s %10s %10s %10s %10s' % ('cache', 'requests', 'req/s', 'p50 ms', 'p99 ms'))
+        rng = random.Random(BENCHSEED)
+        cold = rng.sample(urls, len(urls))
+        warm = [rng.choices(urls, k=BENCHREQUESTS) for i in range(BENCHVIEWERS)]
+        for label, requests, revalidate in [
+            ('cold', [cold[i::BENCHVIEWERS] for i in range(BENCHVIEWERS)], False),
+            ('warm', warm, False),
+            ('revalidate', warm, True),
+        ]:
+            latencies = []
+            viewers = [threading.Thread(target=view, args=(urls, revalidate, latencies)) for urls in requests]
+            start = time.perf_counter()
+            for viewer in viewers:
+                viewer.start()
+            for viewer in viewers:
+                viewer.join()
+            elapsed = time.perf_counter() - start
+            latencies.sort()
+            p50, p99 = (1000*latencies[min(len(latencies)-1, len(latencies)*p//100)] for p in (50, 99))
+            print('%-12s %10s %10.0f %10.2f %10.2f' % (label, len(latencies), len(latencies)/elapsed, p50, p99))
+        server.shutdown()
+        server.server_close()
+
+BENCHSTROKES = 200000
+BENCHSTROKEDENSITY = 50
+BENCHPICKS = 1000
+
+def bench_strokes():
+    # Time to index BENCHSTROKES short strokes, about BENCHSTROKEDENSITY
+    # per chunk, to pick the stroke under BENCHPICKS points and
+    # those in as many window-sized rectangles, and to remove strokes one
+    # by one, drawing their chunks again from the strokes left there
+    size = args.chunk_size
+    side = int(math.sqrt(BENCHSTROKES/BENCHSTROKEDENSITY))*size
+    rng = random.Random(BENCHSEED)
+    strokes = []
+    for i in range(BENCHSTROKES):
+        x, y = rng.randrange(-side, 0), rng.randrange(-side, 0)
+        strokes.append(([(x+rng.randrange(-32, 33), y+rng.randrange(-32, 33)) for j in range(rng.randrange(2, 8))], rng.choice(colors), rng.randrange(1, 8)))
+    surface = StrokeSurface(size)
+    start = time.perf_counter()
+    for id, stroke in enumerate(strokes):
+        surface.index(id, stroke)
+    index = time.perf_counter()-start
+    points = [pygame.Rect(rng.randrange(-side, 0), rng.randrange(-side, 0), 0, 0) for i in range(BENCHPICKS)]
+    rects = [pygame.Rect(rng.randrange(-side, 0), rng.randrange(-side, 0), *SCREENSIZE) for i in range(BENCHPICKS)]
+    picking = []
+    for picks in (points, rects):
+        start = time.perf_counter()
+        found = sum(len(surface.hit(rect)) for rect in picks)
+        picking.append(((time.perf_counter()-start)/len(picks), found/len(picks)))
+    removed = rng.sample(range(BENCHSTROKES), 100)
+    start = time.perf_counter()
+    for id in removed:
+        surface.change({id: None})
+    remove = (time.perf_counter()-start)/len(removed)
+    print('%s strokes over %s chunks of %sx%s, %s picks' % (BENCHSTROKES, len(surface.grid), size, size, BENCHPICKS))
+    print('%-16s %14.0f strokes/s' % ('index', BENCHSTROKES/index))
+    for label, (elapsed, found) in zip(('pick point', 'pick %sx%s' % SCREENSIZE), picking):
+        print('%-16s %14.3f ms/pick %10.1f strokes/pick' % (label, 1000*elapsed, found))
+    print('%-16s %14.3f ms/stroke' % ('remove', 1000*remove))
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'flush': bench_flush,
+    'chunks': bench_backends,
+    'serve': bench_serve,
+    'tiles': bench_tiles,
+    'strokes': bench_strokes,
+}
+
+
 
 #############
 ### SETUP ###
 #############
 
-# Session dir
-# ***********
-if not os.path.isdir(os.path.join(DIR,SESSION)):
-    os.makedirs(os.path.join(DIR,SESSION))
-
-# Cursession dir
-# **************
-if not os.path.isdir(os.path.join(BASEDIR,SESSION)):
-    os.makedirs(os.path.join(BASEDIR,SESSION))
-    
-# Pygame
+pool = None
+# the chunk pool, see get_pool
+pool_lock = threading.Lock()
+link = None
+# the connection to a board server, see Link
+server = None
+# the BoardServer of a board shared with --serve, see serve
+writer = None
+# the thread saving sessions and pages, see Writer
+board = None
+# the Board being drawn on, see open_board
+startup = []
+# (step, seconds since start_time) at the end of each startup step
+
+# Board
+# *****
+def open_board():
+    # Opens the session and replays its journal, unless the board is the
+    # server's; chunks are only decoded when first shown
+    global board
+    board = Board(os.path.join(BASEDIR, SESSION))
+    if link is not None:
+        # the board is the server's, which sends the chunks in view
+        board.load((0,0), (link.chunksize, {}, None))
+    else:
+        board.load(*load_cursession())
+        try:
+            board.load_layers()
+        except Exception as e:
+            print('Error while trying to restore the layers: %s' % e)
+    board.journal = Journal(board.path, board.store.journal)
+    if link is not None:
+        link.start()
+        link.send('view', board.offset, SCREENSIZE)
+    elif board.journal.generations():
+        print('Replayed %s journaled operations' % replay_journal())
+    board.pyramid = load_pyramid()
+    if AUTOSAVE:
+        pygame.time.set_timer(AUTOSAVE_EVENT, AUTOSAVE)
+
+# Window
 # ******
-pygame.init()
-pygame.mixer.quit()
-
 fontsize = 24
-font = pygame.font.Font(None, fontsize)
+font = None
 
-screen = pygame.display.set_mode(SCREENSIZE)
+screen = None
+screen_rect = pygame.Rect((0,0), SCREENSIZE)
 
-pygame.display.set_caption('BlackBBoard - %s' % SESSION)
-icon = pygame.image.load(os.path.join(BASEDIR, 'blackbboard.png'))
-pygame.display.set_icon(icon)
-print('Icon made by Good Ware from flaticon.com')
+dirty = []
+# screen rectangles to recomposite and push on next render
+full_redraw = True
+overlay_rect = None
 
-offset, surface = load_cursession()
-surface = Surface(*surface)
-
-popup_surface = pygame.Surface((screen.get_width(), fontsize))
-popup_surface.fill(white)
 popup_pos = 0,0
-
-tool_surface = pygame.Surface((screen.get_width()//2, fontsize))
-tool_surface.fill(white)
 tool_pos = 0,fontsize
+color_pos = SCREENSIZE[0]//2+2,fontsize
+color_hitbox = Hitbox(color_pos, add_tuples(color_pos, (SCREENSIZE[0]//2, fontsize)))
+
+DEBUGSTEPS = 8
+debug = False
+debug_pos = 0,2*fontsize
+
+overview = False
+overview_level = 1
+overview_center = (0,0)
+
+profiling = False
+profile_pos = SCREENSIZE[0]//2+2,2*fontsize
 
-color_surface = pygame.Surface((screen.get_width()//2,fontsize))
-color_surface.fill(white)
-color_pos = screen.get_width()//2+2,fontsize
-color_hitbox = Hitbox(color_pos, add_tuples(color_pos, (color_surface.get_width(), color_surface.get_height())))
+def open_window():
+    # Only the display and the fonts are initialised, pygame.init would
+    # also open the audio device
+    global font, screen, popup_surface, tool_surface, color_surface, debug_surface, profile_surface
+    pygame.display.init()
+    pygame.font.init()
+    font = pygame.font.Font(None, fontsize)
 
-for i, color in enumerate(colors):
-    pos = color_surface.get_height()*(i+1)+color_surface.get_height()//2,color_surface.get_height()//2
-    radius = color_surface.get_height()//2
-    pygame.gfxdraw.filled_circle(color_surface, *pos, radius, color)
+    screen = pygame.display.set_mode(SCREENSIZE)
 
-pygame.mouse.set_cursor(*pygame.cursors.tri_left)
+    pygame.display.set_caption('BlackBBoard - %s' % SESSION)
+    icon = pygame.image.load(os.path.join(BASEDIR, 'blackbboard.png'))
+    pygame.display.set_icon(icon)
+    print('Icon made by Good Ware from flaticon.com')
+
+    popup_surface = pygame.Surface((screen.get_width(), fontsize))
+    popup_surface.fill(white)
+
+    tool_surface = pygame.Surface((screen.get_width()//2, fontsize))
+    tool_surface.fill(white)
+
+    color_surface = pygame.Surface((screen.get_width()//2,fontsize))
+    color_surface.fill(white)
+
+    debug_surface = pygame.Surface((screen.get_width(), fontsize*(DEBUGSTEPS+2)+4))
+
+    profile_surface = pygame.Surface((screen.get_width()//2, fontsize*PROFILELINES+4))
+
+    for i, color in enumerate(colors):
+        pos = color_surface.get_height()*(i+1)+color_surface.get_height()//2,color_surface.get_height()//2
+        radius = color_surface.get_height()//2
+        pygame.gfxdraw.filled_circle(color_surface, *pos, radius, color)
+
+    if not HEADLESS:
+        pygame.mouse.set_cursor(*pygame.cursors.tri_left)
+    chtool(tool_map[lock.lock])
 
 
 
@@ -525,184 +3697,326 @@ coff = 0
 maxcoff = 0
 anchw = penwidth
 
-buffer = None
-# the clipboard for cut/copy/paste tools
-
-temp_surf = pygame.Surface(SCREENSIZE, SRCALPHA)
-temp_surf.fill(transparent)
-temp_surf.set_colorkey(white)
-need_flush = False
-
 page = 1
-while os.path.isfile(os.path.join(DIR, SESSION, ("%s-%s.%s" % (SESSION, page, FORMAT)))):
-    page += 1
+
 
 
 ###############
 ## MAIN LOOP ##
 ###############
 
-popup('Current session: %s' % SESSION)
-
-clock = pygame.time.Clock()
-
 rendered_pos = []
-
-while True:
-    for event in pygame.event.get():
-        pos = pygame.mouse.get_pos()
-        if event.type == pygame.QUIT: quit()
-        #elif event.type == VIDEORESIZE:
-        #    screen = pygame.display.set_mode((event.w, event.h), RESIZABLE)
-        elif event.type == MOUSEBUTTONUP and event.button == 1:
-            isdown = False
-            flush()
-            if lock.lock == 'm1':
-                islock = False
-                lock.lock = None
-            elif lock.lock == 'm3':
-                delete(surface, anchor, pos)
-            elif lock.lock == 'm2':
-                pass
-            elif lock.lock == KEY_RESIZE:
-                anchw = penwidth
-                pygame.mouse.set_pos(anchor)
-                pygame.mouse.set_visible(True)
-            elif lock.lock == KEY_CUT:
-                cut(surface, anchor, pos)
-            elif lock.lock == KEY_COPY:
-                copy(surface, anchor, pos)
-            elif lock.lock == KEY_DELETE:
-                delete(surface, anchor, pos)
-            elif lock.lock == KEY_FILL:
-                fill(surface, anchor, pos, pencolor)
-            anchor = (None,None)
-        elif event.type == MOUSEBUTTONDOWN and event.button == 1:
-            if not islock:
-                if pos in color_hitbox:
-                    ncolor = screen.get_at(pos)
-                    if ncolor != white:
-                        pencolor = ncolor
-                        continue
-                islock = True
-                lock.lock = 'm1'
-            elif lock.lock == KEY_RESIZE:
-                pygame.mouse.set_visible(False)
-                anchw = penwidth
-                coff = 0
-                maxcoff = -(anchw-1)*PPP
-            isdown = True
-            anchor = pos
-        elif event.type == MOUSEBUTTONDOWN and event.button == 3:
-            if not islock:
-                islock = True
-                lock.lock = 'm3'
-        elif event.type == MOUSEBUTTONDOWN and event.button == 2:
-            if not islock:
-                islock = True
-                lock.lock = 'm2'
-        elif event.type == MOUSEBUTTONUP and event.button == 3:
-            if lock.lock == 'm3':
-                islock = False
-                lock.lock = None
-        elif event.type == MOUSEBUTTONUP and event.button == 2:
-            if lock.lock == 'm2':
-                islock = False
-                lock.lock = None
-        elif event.type == MOUSEMOTION:
-            if not islock:
-                pass
-            if not isdown:
-                pass
-            if lock.lock == 'm1' and isdown:
-                if anchor == (None,None):
-                    last = pos
-                else:
-                    last = anchor
-                anchor = pos
-                draw_line(surface, last, anchor, pencolor, penwidth)
-            elif lock.lock == 'm2' and isdown:
-                flush()
-                d = mul_tuples(MOVESCALE, sub_tuples(pos, anchor))
-                offset = add_tuples(offset, d)
-                anchor = pos
-            elif lock.lock == KEY_RESIZE and isdown:
-                coff = pos[0] - anchor[0]
-                coff = max(coff,maxcoff)
-                penwidth = max(anchw+coff//PPP,1)
-                chtool(tool_map[lock.lock] + (' %s' % penwidth))
-        elif event.type == KEYDOWN:
-            if event.key == ord(KEY_SAVE):
-                save()
-            elif event.key == ord(KEY_QUIT):
-                quit()
-            elif event.key == ord(KEY_RESIZE):
-                if not islock:
-                    islock = True
-                    lock.lock = KEY_RESIZE
-                    chtool(tool_map[lock.lock] + (' %s' % penwidth))
-            elif event.key == ord(KEY_CUT):
-                if not islock:
-                    islock = True
-                    lock.lock = KEY_CUT
-            elif event.key == ord(KEY_COPY):
-                if not islock:
-                    islock = True
-                    lock.lock = KEY_COPY
-            elif event.key == ord(KEY_PASTE):
-                paste(surface, pos)
-            elif event.key == ord(KEY_DELETE):
-                if not islock:
-                    islock = True
-                    lock.lock = KEY_DELETE
-            elif event.key == ord(KEY_FILL):
-                if not islock:
-                    islock = True
-                    lock.lock =KEY_FILL
-            elif event.key == ord(KEY_UNDO):
-                undo()
-            elif event.key == ord(KEY_SAVECS):
-                popup('saving current session...')
-                render()
-                save_cursession()
-                popup('saved current session!')
-        elif event.type == KEYUP:
-            if event.key == ord(KEY_RESIZE):
-                if lock.lock == KEY_RESIZE:
-                    islock = False
-                    lock.lock = None
-                    if anchor != (None,None):
+first_frame = None
+
+idle_stats = {'frames': 0, 'skipped': 0, 'waits': 0, 'wall': 0., 'cpu': 0.}
+
+stroke = []
+# points of the pen stroke not drawn yet, starting with the last drawn one
+
+replay_stats = {'events': 0, 'motions': 0, 'batches': 0}
+replay_mouse = (0,0)
+trace_start = time.perf_counter()
+
+def main_loop():
+    global islock, isdown, anchor, coff, maxcoff, anchw, penwidth, pencolor
+    clock = pygame.time.Clock()
+    while True:
+        events = next_events()
+        with timings.phase('events'):
+            for event in events:
+                if event.type != MOUSEMOTION:
+                    draw_stroke()
+                pos = event.pos if hasattr(event, 'pos') else mouse_pos()
+                if event.type == pygame.QUIT: quit()
+                elif event.type == AUTOSAVE_EVENT:
+                    autosave()
+                elif event.type == WRITER_EVENT:
+                    writer_event(event)
+                elif event.type == JOURNAL_EVENT:
+                    journal_event()
+                elif event.type == NET_EVENT:
+                    net_event(event)
+                elif overview:
+                    overview_event(event, pos)
+                #elif event.type == VIDEORESIZE:
+                #    screen = pygame.display.set_mode((event.w, event.h), RESIZABLE)
+                elif event.type == MOUSEBUTTONUP and event.button == 1:
+                    isdown = False
+                    del stroke[:]
+                    flush()
+                    if lock.lock == 'm1':
+                        islock = False
+                        lock.lock = None
+                    elif lock.lock == 'm3':
+                        delete(board.surface, anchor, pos)
+                    elif lock.lock == 'm2':
+                        journal_op('offset', board.offset)
+                    elif lock.lock == KEY_RESIZE:
                         anchw = penwidth
                         pygame.mouse.set_pos(anchor)
                         pygame.mouse.set_visible(True)
-                        anchor = (None,None)
-            elif event.key == ord(KEY_CUT):
-                if lock.lock == KEY_CUT:
-                    islock = False
-                    lock.lock = None
-                    if anchor != (None,None):
-                        cut(surface, anchor, pos)
-                        anchor = (None, None)
-            elif event.key == ord(KEY_COPY):
-                if lock.lock == KEY_COPY:
-                    islock = False
-                    lock.lock = None
-                    if anchor != (None,None):
-                        copy(surface, anchor, pos)
-                        anchor = (None,None)
-            elif event.key == ord(KEY_DELETE):
-                if lock.lock == KEY_DELETE:
-                    islock = False
-                    lock.lock = None
-                    if anchor != (None,None):
-                        delete(surface, anchor, pos)
-                        anchor = (None,None)
-            elif event.key == ord(KEY_FILL):
-                if lock.lock == KEY_FILL:
-                    islock = False
-                    lock.lock = None
-                    if anchor != (None,None):
-                        fill(surface, anchor, pos, pencolor)
-                        anchor = (None,None)
+                    elif lock.lock == KEY_CUT:
+                        cut(board.surface, anchor, pos)
+                    elif lock.lock == KEY_COPY:
+                        copy(board.surface, anchor, pos)
+                    elif lock.lock == KEY_DELETE:
+                        delete(board.surface, anchor, pos)
+                    elif lock.lock == KEY_FILL:
+                        fill(board.surface, anchor, pos, pencolor)
+                    anchor = (None,None)
+                elif event.type == MOUSEBUTTONDOWN and event.button == 1:
+                    if not islock:
+                        if pos in color_hitbox:
+                            ncolor = screen.get_at(pos)
+                            if ncolor != white:
+                                pencolor = ncolor
+                                continue
+                        islock = True
+                        lock.lock = 'm1'
+                    elif lock.lock == KEY_RESIZE:
+                        pygame.mouse.set_visible(False)
+                        anchw = penwidth
+                        coff = 0
+                        maxcoff = -(anchw-1)*PPP
+                    isdown = True
+                    anchor = pos
+                elif event.type == MOUSEBUTTONDOWN and event.button == 3:
+                    if not islock:
+                        islock = True
+                        lock.lock = 'm3'
+                elif event.type == MOUSEBUTTONDOWN and event.button == 2:
+                    if not islock:
+                        islock = True
+                        lock.lock = 'm2'
+                elif event.type == MOUSEBUTTONUP and event.button == 3:
+                    if lock.lock == 'm3':
+                        islock = False
+                        lock.lock = None
+                elif event.type == MOUSEBUTTONUP and event.button == 2:
+                    if lock.lock == 'm2':
+                        islock = False
+                        lock.lock = None
+                elif event.type == MOUSEMOTION:
+                    if not islock:
+                        pass
+                    if not isdown:
+                        pass
+                    if lock.lock == 'm1' and isdown:
+                        if not stroke:
+                            stroke.append(pos if anchor == (None,None) else anchor)
+                        anchor = pos
+                        stroke.append(pos)
+                    elif lock.lock == 'm2' and isdown:
+                        flush()
+                        d = mul_tuples(MOVESCALE, sub_tuples(pos, anchor))
+                        board.offset = add_tuples(board.offset, d)
+                        anchor = pos
+                        if d != (0,0):
+                            damage_all()
+                    elif lock.lock == KEY_RESIZE and isdown:
+                        coff = pos[0] - anchor[0]
+                        coff = max(coff,maxcoff)
+                        penwidth = max(anchw+coff//PPP,1)
+                        chtool(tool_map[lock.lock] + (' %s' % penwidth))
+                elif event.type == KEYDOWN:
+                    if event.key == ord(KEY_SAVE):
+                        save()
+                    elif event.key == ord(KEY_QUIT):
+                        quit()
+                    elif event.key == ord(KEY_RESIZE):
+                        if not islock:
+                            islock = True
+                            lock.lock = KEY_RESIZE
+                            chtool(tool_map[lock.lock] + (' %s' % penwidth))
+                    elif event.key == ord(KEY_CUT):
+                        if not islock:
+                            islock = True
+                            lock.lock = KEY_CUT
+                    elif event.key == ord(KEY_COPY):
+                        if not islock:
+                            islock = True
+                            lock.lock = KEY_COPY
+                    elif event.key == ord(KEY_PASTE):
+                        paste(board.surface, pos)
+                    elif event.key == ord(KEY_BUCKET):
+                        bucket(board.surface, pos, pencolor)
+                    elif event.key == ord(KEY_DELETE):
+                        if not islock:
+                            islock = True
+                            lock.lock = KEY_DELETE
+                    elif event.key == ord(KEY_FILL):
+                        if not islock:
+                            islock = True
+                            lock.lock =KEY_FILL
+                    elif event.key == ord(KEY_UNDO):
+                        undo()
+                    elif event.key == ord(KEY_REDO):
+                        redo()
+                    elif event.key == ord(KEY_DEBUG):
+                        toggle_debug()
+                    elif event.key == ord(KEY_PROFILE):
+                        toggle_profile()
+                    elif event.key == ord(KEY_OVERVIEW):
+                        toggle_overview()
+                    elif event.key == ord(KEY_EXPORT):
+                        export()
+                    elif event.key == ord(KEY_SAVECS):
+                        popup('saving current session...')
+                        save_cursession()
+                    elif event.key == ord(KEY_LAYER):
+                        next_layer()
+                    elif event.key == ord(KEY_HIDE):
+                        toggle_layer()
+                    elif event.key == ord(KEY_RAISE):
+                        raise_layer()
+                    elif event.key == ord(KEY_STROKES):
+                        stroke_layer()
+                    elif event.key == ord(KEY_RESTYLE):
+                        restyle(pos)
+                elif event.type == KEYUP:
+                    if event.key == ord(KEY_RESIZE):
+                        if lock.lock == KEY_RESIZE:
+                            islock = False
+                            lock.lock = None
+                            if anchor != (None,None):
+                                anchw = penwidth
+                                pygame.mouse.set_pos(anchor)
+                                pygame.mouse.set_visible(True)
+                                anchor = (None,None)
+                    elif event.key == ord(KEY_CUT):
+                        if lock.lock == KEY_CUT:
+                            islock = False
+                            lock.lock = None
+                            if anchor != (None,None):
+                                cut(board.surface, anchor, pos)
+                                anchor = (None, None)
+                    elif event.key == ord(KEY_COPY):
+                        if lock.lock == KEY_COPY:
+                            islock = False
+                            lock.lock = None
+                            if anchor != (None,None):
+                                copy(board.surface, anchor, pos)
+                                anchor = (None,None)
+                    elif event.key == ord(KEY_DELETE):
+                        if lock.lock == KEY_DELETE:
+                            islock = False
+                            lock.lock = None
+                            if anchor != (None,None):
+                                delete(board.surface, anchor, pos)
+                                anchor = (None,None)
+                    elif event.key == ord(KEY_FILL):
+                        if lock.lock == KEY_FILL:
+                            islock = False
+                            lock.lock = None
+                            if anchor != (None,None):
+                                fill(board.surface, anchor, pos, pencolor)
+                                anchor = (None,None)
+        draw_stroke()
+        render()
+        idle_stats['frames'] += 1
+        if PROFILE:
+            end_frame()
+        if not REPLAY:
+            clock.tick(FPS)
+
+
+
+############
+### MAIN ###
+############
+
+def main():
+    global writer, link, board, page, trace_start, trace_in, trace_out, profile_out
+    startup_step('imports')
+    if HEADLESS or args.serve or args.bench:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+
+    # Compaction
+    if args.compact:
+        board = Board(os.path.join(BASEDIR, SESSION))
+        print('\n'.join(compact_cursession()))
+        sys.exit(0)
+
+    # Benchmarks
+    if args.bench:
+        BENCHMARKS[args.bench]()
+        sys.exit(0)
+
+    # Export
+    if args.export:
+        writer = Writer()
+        board = Board(os.path.join(BASEDIR, SESSION))
+        board.load(*load_cursession())
+        try:
+            board.load_layers()
+            print(export_board(args.export, args.export_rect, args.export_scale))
+        except Exception as e:
+            print('Error while exporting board: %s' % e)
+            sys.exit(1)
+        sys.exit(0)
+
+    # Batch
+    if args.batch:
+        writer = Writer()
+        sys.exit(run_batch(args.batch, args.sessions or [SESSION]))
+
+    # Tile server
+    if args.serve_tiles:
+        try:
+            serve_tiles(parse_address(args.serve_tiles, 'localhost'))
+        except (OSError, ValueError) as e:
+            print('Error while serving tiles on %s: %s' % (args.serve_tiles, e))
+            sys.exit(1)
+        sys.exit(0)
+
+    # Session dirs
+    if not os.path.isdir(os.path.join(DIR,SESSION)):
+        os.makedirs(os.path.join(DIR,SESSION))
+    if not os.path.isdir(os.path.join(BASEDIR,SESSION)):
+        os.makedirs(os.path.join(BASEDIR,SESSION))
+
+    # Server
+    if args.serve:
+        # nothing is ever drawn on the server itself, only its timers run
+        pygame.display.init()
+        writer = Writer()
+        open_board()
+        try:
+            serve(parse_address(args.serve))
+        except (OSError, ValueError) as e:
+            print('Error while serving on %s: %s' % (args.serve, e))
+            sys.exit(1)
+        sys.exit(0)
+
+    # Client
+    if args.connect:
+        try:
+            link = Link(parse_address(args.connect, 'localhost'))
+        except (OSError, ValueError) as e:
+            print('Error while connecting to %s: %s' % (args.connect, e))
+            sys.exit(1)
+
+    # Board
+    open_window()
+    startup_step('window')
+    writer = Writer()
+    open_board()
+    startup_step('session')
+    while os.path.isfile(os.path.join(DIR, SESSION, ("%s-%s.%s" % (SESSION, page, FORMAT)))):
+        page += 1
+    if PROFILE:
+        profile_out = open(PROFILE, 'w')
+    if REPLAY:
+        trace_in = open(REPLAY)
+    if RECORD:
+        trace_out = open(RECORD, 'w')
+
+    # the first frame only decodes the chunks in view, the others around
+    # it stream in while the board is idle, see prefetch
+    popup('Current session: %s' % SESSION)
     render()
-    clock.tick(FPS)
+    trace_start = time.perf_counter()
+    main_loop()
+
+if __name__ == '__main__':
+    main()